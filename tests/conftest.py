@@ -0,0 +1,14 @@
+"""Shared fixtures, the modules import each other by name so wfc is put on the path."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'wfc'))
+
+import tileset # pylint: disable=wrong-import-position
+
+@pytest.fixture(scope='session')
+def tiles():
+    """The default tileset."""
+    return tileset.load()
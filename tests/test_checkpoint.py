@@ -0,0 +1,49 @@
+"""Checkpoint and resume."""
+import pytest
+
+import solver
+
+def solve_steps(s: solver.Solver, steps: int) -> None:
+    """Take up to steps solver steps."""
+    for _ in range(steps):
+        if s.solve():
+            break
+
+@pytest.mark.parametrize('propagation', solver.PROPAGATION)
+@pytest.mark.parametrize('steps', [1, 50, 400])
+@pytest.mark.parametrize('seed', range(3))
+def test_resume_gives_the_same_grid(tiles, tmp_path, seed, steps, propagation):
+    path = str(tmp_path / 'map.checkpoint')
+    s = solver.Solver(tiles, seed, propagation=propagation, recovery=solver.Recovery(1, None, 2),
+                      width=30, height=30)
+    solve_steps(s, steps)
+    s.checkpoint(path)
+    s.run()
+    resumed = solver.Solver.resume(path, tiles)
+    resumed.run()
+    assert resumed.tile_grid() == s.tile_grid()
+    assert resumed.steps == s.steps
+    assert resumed.contradictions == s.contradictions
+    assert resumed.backtracks == s.backtracks
+
+def test_resume_keeps_constraints(tiles, tmp_path):
+    path = str(tmp_path / 'map.checkpoint')
+    constraints = solver.Constraints(tiles)
+    constraints.pin(3, 4, 'ew')
+    constraints.region(10, 10, 5, 5, ['ns', 'nesw'])
+    s = solver.Solver(tiles, 1, width=20, height=20, constraints=constraints)
+    solve_steps(s, 20)
+    s.checkpoint(path)
+    s.run()
+    resumed = solver.Solver.resume(path, tiles)
+    resumed.run()
+    assert resumed.tile_grid() == s.tile_grid()
+    assert resumed._constraints == s._constraints # pylint: disable=protected-access
+
+def test_periodic_checkpoints_resume(tiles, tmp_path):
+    path = str(tmp_path / 'map.checkpoint')
+    s = solver.Solver(tiles, 2, width=24, height=24)
+    s.run(path, 100)
+    resumed = solver.Solver.resume(path, tiles)
+    resumed.run()
+    assert resumed.tile_grid() == s.tile_grid()
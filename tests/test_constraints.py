@@ -0,0 +1,60 @@
+"""Pins and regions."""
+import pytest
+
+import solver
+
+def pins(tiles) -> solver.Constraints:
+    """A pin and a region that the default tileset can satisfy."""
+    constraints = solver.Constraints(tiles)
+    constraints.pin(0, 0, 'nesw')
+    constraints.pin(5, 7, 'ew')
+    constraints.region(8, 2, 4, 3, ['ns', 'nesw'])
+    return constraints
+
+def assert_kept(s: solver.Solver, constraints: solver.Constraints) -> None:
+    """Check every constrained cell only has choices its constraint allows."""
+    for (row, col), mask in constraints.masks().items():
+        domain = s.domain(row * s.width + col)
+        assert domain != 0
+        assert domain & ~mask == 0
+
+@pytest.mark.parametrize('propagation', solver.PROPAGATION)
+def test_pins_are_kept_through_restarts(tiles, propagation):
+    constraints = pins(tiles)
+    s = solver.Solver(tiles, 1, propagation=propagation, recovery=solver.Recovery(0, None, 3),
+                      width=16, height=16, constraints=constraints)
+    for _ in range(30):
+        s.solve()
+    # what recover does for a restart
+    s._reset(solver.derive_seed(1, 1)) # pylint: disable=protected-access
+    assert_kept(s, constraints)
+    assert s.run()
+    assert_kept(s, constraints)
+
+def test_a_run_that_restarts_keeps_pins(tiles):
+    constraints = pins(tiles)
+    # seed 8 hits a contradiction on this grid
+    s = solver.Solver(tiles, 8, wrap=True, recovery=solver.Recovery(0, None, 5), width=30, height=30)
+    s.constrain(constraints)
+    assert s.run()
+    assert s.restarts > 0
+    assert_kept(s, constraints)
+
+@pytest.mark.parametrize('pin', [
+    {'row': '0', 'col': 0, 'tile': 'ew'},
+    {'row': 0.5, 'col': 0, 'tile': 'ew'},
+    {'row': 0, 'col': True, 'tile': 'ew'},
+    {'row': 0, 'col': 0, 'tile': 'unknown'},
+    {'row': 0, 'col': 0}
+])
+def test_malformed_pins_are_value_errors(tiles, pin):
+    with pytest.raises(ValueError):
+        solver.Constraints.from_dict(tiles, {'pins': [pin]})
+
+def test_unsatisfiable_pins(tiles):
+    constraints = solver.Constraints(tiles)
+    constraints.pin(0, 0, 'ew')
+    constraints.pin(0, 1, 'ns')
+    s = solver.Solver(tiles, 1, width=8, height=8)
+    with pytest.raises(solver.UnsatisfiableError):
+        s.constrain(constraints)
@@ -0,0 +1,56 @@
+"""ac3 and ac4 propagation."""
+import random
+
+import pytest
+
+import solver
+
+WIDTH = 12
+HEIGHT = 10
+
+def narrow(s: solver.Solver, seed: int, count: int) -> list[list[int]]:
+    """
+    Rule out a random tile of a random undecided cell count times,
+    propagating each, get the domains after each propagation until
+    one leaves a cell with no choices
+    """
+    rng = random.Random(seed)
+    states = []
+    for _ in range(count):
+        undecided = [index for index in range(WIDTH * HEIGHT) if s.domain(index).bit_count() > 1]
+        if len(undecided) == 0:
+            break
+        index = rng.choice(undecided)
+        domain = s.domain(index)
+        removed = 1 << rng.choice(solver.indices(domain))
+        s.set_domain(index, domain & ~removed)
+        s.propagate([(index, removed)])
+        if s.contradictions > 0:
+            break
+        states.append([s.domain(index) for index in range(WIDTH * HEIGHT)])
+    return states
+
+@pytest.mark.parametrize('wrap', [False, True])
+@pytest.mark.parametrize('seed', range(8))
+def test_ac4_reaches_the_ac3_fixpoint(tiles, seed, wrap):
+    ac3 = narrow(solver.Solver(tiles, seed, wrap, 'ac3', width=WIDTH, height=HEIGHT), seed, 400)
+    ac4 = narrow(solver.Solver(tiles, seed, wrap, 'ac4', width=WIDTH, height=HEIGHT), seed, 400)
+    assert len(ac3) > 0
+    assert ac4 == ac3
+
+@pytest.mark.parametrize('seed', range(4))
+def test_ac4_reaches_the_ac3_fixpoint_from_constraints(tiles, seed):
+    rng = random.Random(seed)
+    constraints = solver.Constraints(tiles)
+    for _ in range(6):
+        constraints.pin(rng.randrange(HEIGHT), rng.randrange(WIDTH), rng.choice(tiles.names()))
+    domains = []
+    for propagation in solver.PROPAGATION:
+        s = solver.Solver(tiles, seed, propagation=propagation, width=WIDTH, height=HEIGHT)
+        try:
+            s.constrain(constraints)
+        except solver.UnsatisfiableError as ex:
+            domains.append(sorted(ex.cells))
+        else:
+            domains.append([s.domain(index) for index in range(WIDTH * HEIGHT)])
+    assert domains[1] == domains[0]
@@ -1,8 +1,36 @@
 """Wave function collapse"""
 
 import argparse
+import json
 import logging
+import os
+import random
+import sys
+import batch
+import bench
+import instrument
+import service
 import solver
+import tileset
+import world
+
+def add_solver_arguments(parser: argparse.ArgumentParser, suppress: bool = False) -> None:
+    """
+    Add the options shared by the window and the subcommands, with suppress
+    they have no defaults so a subcommand keeps options given before it
+    """
+    def default(value):
+        return argparse.SUPPRESS if suppress else value
+    parser.add_argument('--wrap', required=False, default=default(False), dest='wrap', action='store_true')
+    parser.add_argument('-s', '--seed', type=int, required=False, default=default(None), dest='seed')
+    parser.add_argument('-p', '--propagation', type=str, required=False, default=default('ac3'), dest='propagation', choices=solver.PROPAGATION)
+    parser.add_argument('-e', '--entropy', type=str, required=False, default=default('count'), dest='entropy', choices=solver.ENTROPY)
+    parser.add_argument('-b', '--backtrack', type=int, required=False, default=default(0), dest='backtrack')
+    parser.add_argument('--maxbacktracks', type=int, required=False, default=default(None), dest='maxbacktracks')
+    parser.add_argument('-r', '--restarts', type=int, required=False, default=default(0), dest='restarts')
+    parser.add_argument('--tileset', type=str, required=False, default=default(tileset.DEFAULT_PATH), dest='tileset')
+    parser.add_argument('--size', type=batch.parse_size, required=False, default=default((solver.TILE_X, solver.TILE_Y)), dest='size')
+    parser.add_argument('--constraints', type=str, required=False, default=default(None), dest='constraints')
 
 if __name__ == '__main__':
     loglevels = [
@@ -13,63 +41,137 @@ if __name__ == '__main__':
         'CRITICAL'
     ]
 
+    # options given after a subcommand
+    solver_parser = argparse.ArgumentParser(add_help=False)
+    add_solver_arguments(solver_parser, suppress=True)
+
     parser = argparse.ArgumentParser(description='solve sudoku')
+    add_solver_arguments(parser)
     parser.add_argument('-d', '--delay', type=float, required=False, default=1.0, dest='delay')
     parser.add_argument('-l', '--logging', type=str, required=False, default='ERROR', dest='logging', choices=loglevels)
     parser.add_argument('--shownumbers', required=False, default=False, dest='shownumbers', action='store_true')
     parser.add_argument('--showchanged', required=False, default=False, dest='showchanged', action='store_true')
-    parser.add_argument('--wrap', required=False, default=False, dest='wrap', action='store_true')
-    parser.add_argument('-s', '--seed', type=int, required=False, default=None, dest='seed')
+    parser.add_argument('--budget', type=float, required=False, default=0, dest='budget')
+    parser.add_argument('--fps', type=int, required=False, default=60, dest='fps')
+    parser.add_argument('--thread', required=False, default=False, dest='thread', action='store_true')
+    parser.add_argument('--imagecache', type=int, required=False, default=1024, dest='imagecache')
+    parser.add_argument('--weighted', required=False, default=False, dest='weighted', action='store_true')
+    parser.add_argument('--instrument', type=str, required=False, default=None, dest='instrument', choices=instrument.INSTRUMENTS)
+    subparsers = parser.add_subparsers(dest='command')
+
+    generate_parser = subparsers.add_parser('generate', parents=[solver_parser], help='generate maps without a display')
+    generate_parser.add_argument('-n', '--count', type=int, required=False, default=1, dest='count')
+    generate_parser.add_argument('-j', '--jobs', type=int, required=False, default=None, dest='jobs')
+    generate_parser.add_argument('-o', '--output', type=str, required=False, default='maps', dest='output')
+    generate_parser.add_argument('--combined', required=False, default=False, dest='combined', action='store_true')
+    generate_parser.add_argument('--checkpoint', type=str, required=False, default=None, dest='checkpoint')
+    generate_parser.add_argument('--checkpointevery', type=int, required=False, default=10000, dest='checkpointevery')
+    generate_parser.add_argument('--instrument', type=str, required=False, default=argparse.SUPPRESS, dest='instrument', choices=instrument.INSTRUMENTS)
+
+    race_parser = subparsers.add_parser('race', parents=[solver_parser], help='solve one map with several seeds at once and keep the first clean one')
+    race_parser.add_argument('-n', '--count', type=int, required=False, default=8, dest='count')
+    race_parser.add_argument('-j', '--jobs', type=int, required=False, default=None, dest='jobs')
+    race_parser.add_argument('-o', '--output', type=str, required=False, default='map.json', dest='output')
+
+    world_parser = subparsers.add_parser('world', parents=[solver_parser], help='generate a region of a chunked world, --size is the chunk size')
+    world_parser.add_argument('--region', type=world.parse_region, required=False, default=(0, 0, 64, 64), dest='region')
+    world_parser.add_argument('--cache', type=int, required=False, default=64, dest='cache')
+    world_parser.add_argument('--spill', type=str, required=False, default=None, dest='spill')
+    world_parser.add_argument('-j', '--jobs', type=int, required=False, default=1, dest='jobs')
+    world_parser.add_argument('-o', '--output', type=str, required=False, default='world.json', dest='output')
+
+    export_parser = subparsers.add_parser('export', help='write the image of a map from generate or world as png or raw rgb')
+    export_parser.add_argument('map', type=str)
+    export_parser.add_argument('--tileset', type=str, required=False, default=argparse.SUPPRESS, dest='tileset')
+    export_parser.add_argument('-o', '--output', type=str, required=False, default='map.png', dest='output')
+
+    serve_parser = subparsers.add_parser('serve', parents=[solver_parser], help='solve maps for json requests over http, --tileset, --size and --wrap are the defaults')
+    serve_parser.add_argument('--host', type=str, required=False, default='127.0.0.1', dest='host')
+    serve_parser.add_argument('--port', type=int, required=False, default=8080, dest='port')
+    serve_parser.add_argument('--socket', type=str, required=False, default=None, dest='socket')
+    serve_parser.add_argument('-j', '--jobs', type=int, required=False, default=None, dest='jobs')
+    serve_parser.add_argument('--cache', type=int, required=False, default=256, dest='cache')
+    serve_parser.add_argument('--queue', type=int, required=False, default=64, dest='queue')
+    serve_parser.add_argument('--maxsize', type=batch.parse_size, required=False, default=(1024, 1024), dest='maxsize')
+    serve_parser.add_argument('--tilesetdir', type=str, required=False, default=None, dest='tilesetdir')
+
+    bench_parser = subparsers.add_parser('bench', parents=[solver_parser], help='run solver benchmarks or compare their results')
+    bench.add_arguments(bench_parser)
     args = parser.parse_args()
 
     loglevel = getattr(logging, args.logging, None)
     logging.basicConfig(level=loglevel, format='%(asctime)s %(levelname)s %(name)s %(message)s')
 
-    # connected tile rules
-    road_connect_n = ['ns','nw','ne','nesw','neswew','neswns','new','nes','nws','nhouse']
-    road_connect_e = ['ew','se','ne','nesw','neswew','neswns','new','sew','nes']
-    road_connect_s = ['ns','se','sw','nesw','neswew','neswns','sew','nes','nws']
-    road_connect_w = ['ew','sw','nw','nesw','neswew','neswns','new','sew','nws']
-    # not connected tile rules
-    blank_connect_n = ['none','nonea','noneb','ew','se','sw','sew','sea','swa','ewall','swall','wwall','ewwall']
-    blank_connect_e = ['none','nonea','noneb','ns','sw','nw','nws','nhouse','swa','nwa','nwall','swall','wwall','nswall']
-    blank_connect_s = ['none','nonea','noneb','ew','nw','ne','new','nhouse','nwa','nea','nwall','ewall','wwall','ewwall']
-    blank_connect_w = ['none','nonea','noneb','ns','se','ne','nes','nhouse','nea','sea','nwall','ewall','swall','nswall']
-    # wall connect rules
-    wall_connect_n = ['nwall','nswall']
-    wall_connect_e = ['ewall','ewwall']
-    wall_connect_s = ['swall','nswall']
-    wall_connect_w = ['wwall','ewwall']
-    tiles = {
-        'nesw': { 'rules': { 'n': road_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'neswew': { 'rules':  { 'n': road_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 0.5 },
-        'neswns': { 'rules':  { 'n': road_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 0.5 },
-        'ew': { 'rules':  { 'n': blank_connect_n, 'e': road_connect_e, 's': blank_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'ns': { 'rules':  { 'n': road_connect_n, 'e': blank_connect_e, 's': road_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'none': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'nonea': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 0.25 },
-        'noneb': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 0.25 },
-        'se': { 'rules':  { 'n': road_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'sw': { 'rules':  { 'n': road_connect_n, 'e': road_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'nw': { 'rules': { 'n': blank_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'ne': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'new': { 'rules':  { 'n': blank_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'sew': { 'rules':  { 'n': road_connect_n, 'e': road_connect_e, 's': blank_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'nes': { 'rules':  { 'n': road_connect_n, 'e': blank_connect_e, 's': road_connect_s, 'w': road_connect_w }, 'weight': 1 },
-        'nws': { 'rules':  { 'n': road_connect_n, 'e': road_connect_e, 's': road_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'nhouse': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': road_connect_s, 'w': blank_connect_w }, 'weight': 2 },
-        'sea': { 'rules':  { 'n': ['nea'], 'e': blank_connect_e, 's': blank_connect_s, 'w': ['swa'] }, 'weight': 1 },
-        'swa': { 'rules':  { 'n': ['nwa'], 'e': ['sea'], 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 1 },
-        'nwa': { 'rules':  { 'n': blank_connect_n, 'e': ['nea'], 's': ['swa'], 'w': blank_connect_w }, 'weight': 1 },
-        'nea': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': ['sea'], 'w': ['nwa'] }, 'weight': 1 },
-        'nwall': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': wall_connect_s, 'w': blank_connect_w }, 'weight': 0.25 },
-        'ewall': { 'rules':  { 'n': blank_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': wall_connect_w }, 'weight': 0.25 },
-        'swall': { 'rules':  { 'n': wall_connect_n, 'e': blank_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 0.25 },
-        'wwall': { 'rules':  { 'n': blank_connect_n, 'e': wall_connect_e, 's': blank_connect_s, 'w': blank_connect_w }, 'weight': 0.25 },
-        'nswall': { 'rules':  { 'n': wall_connect_n, 'e': blank_connect_e, 's': wall_connect_s, 'w': blank_connect_w }, 'weight': 0.12 },
-        'ewwall': { 'rules':  { 'n': blank_connect_n, 'e': wall_connect_e, 's': blank_connect_s, 'w': wall_connect_w }, 'weight': 0.12 }
-    }
-    t = solver.TileSet(tiles)
-    s = solver.Solver(t, args.seed, args.wrap)
-    a = solver.App(s, args.delay, args.shownumbers, args.showchanged)
-    a.on_execute()
\ No newline at end of file
+    if args.command in ('race', 'bench') and getattr(args, 'count', 1) < 1:
+        parser.error('--count must be at least 1')
+    r = solver.Recovery(args.backtrack, args.maxbacktracks, args.restarts)
+    try:
+        t = tileset.load(args.tileset)
+    except (OSError, tileset.TileSetError) as ex:
+        parser.error(str(ex))
+    c = None
+    if getattr(args, 'constraints', None) is not None:
+        try:
+            with open(args.constraints, 'r', encoding='utf-8') as file:
+                c = solver.Constraints.from_dict(t, json.load(file))
+        except (OSError, ValueError) as ex:
+            parser.error('constraints {0}: {1}'.format(args.constraints, ex))
+        if args.command in ('world', 'serve', 'bench'):
+            parser.error('--constraints is not supported by {0}'.format(args.command))
+        try:
+            # unsatisfiable constraints fail whatever the seed, check them once up front
+            solver.Solver(t, 0, args.wrap, args.propagation, width=args.size[0], height=args.size[1], constraints=c)
+        except ValueError as ex:
+            parser.error('constraints {0}: {1}'.format(args.constraints, ex))
+    if args.command == 'generate':
+        i = instrument.create(args.instrument)
+        summary = batch.generate(t, args.count, args.output, args.combined, args.jobs, args.seed,
+                                 args.checkpoint, args.checkpointevery,
+                                 wrap=args.wrap, propagation=args.propagation, entropy=args.entropy,
+                                 recovery=r, width=args.size[0], height=args.size[1], instrument=i,
+                                 constraints=c)
+        print(batch.format_summary(summary))
+        if i is not None:
+            print(i.report())
+    elif args.command == 'race':
+        options = {'wrap': args.wrap, 'propagation': args.propagation, 'entropy': args.entropy,
+                   'recovery': r, 'width': args.size[0], 'height': args.size[1], 'constraints': c}
+        result = batch.race(t, args.count, args.jobs, args.seed, **options)
+        print(batch.format_race(result))
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(batch.map_record(result, t.names(), options), file, separators=(',', ':'))
+    elif args.command == 'world':
+        seed = args.seed if args.seed is not None else random.randrange(sys.maxsize)
+        with world.World(t, seed, args.size[0], args.size[1], args.cache, args.spill, args.jobs,
+                         propagation=args.propagation, entropy=args.entropy, recovery=r) as w:
+            x, y, width, height = args.region
+            record = {'seed': seed, 'x': x, 'y': y, 'width': width, 'height': height,
+                      'tiles': t.names(), 'grid': w.region(x, y, width, height)}
+            print(w.stats)
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(record, file, separators=(',', ':'))
+    elif args.command == 'export':
+        import export # pylint: disable=import-outside-toplevel
+        width, height = export.export(args.map, args.output, t)
+        print('{0} {1}x{2}'.format(args.output, width, height))
+    elif args.command == 'serve':
+        try:
+            tileset_dir = args.tilesetdir if args.tilesetdir is not None else os.path.dirname(os.path.abspath(args.tileset))
+            v = service.Service(t, args.jobs, args.cache, args.queue, args.size, args.wrap, args.maxsize, tileset_dir,
+                                propagation=args.propagation, entropy=args.entropy, recovery=r)
+        except ValueError as ex:
+            parser.error(str(ex))
+        service.serve(v, args.host, args.port, args.socket)
+    elif args.command == 'bench':
+        sys.exit(bench.main(args, t, propagation=args.propagation, entropy=args.entropy, recovery=r))
+    else:
+        import app # pylint: disable=import-outside-toplevel
+        # the window outlines checked and changed cells from the instrument's trace
+        i = instrument.create(args.instrument, args.showchanged)
+        s = solver.Solver(t, args.seed, args.wrap, args.propagation, args.entropy, r, args.size[0], args.size[1],
+                          i, c)
+        a = app.App(s, args.delay, args.shownumbers, args.showchanged, args.budget, args.fps, args.thread,
+                    args.imagecache, args.weighted)
+        a.on_execute()
+        if args.instrument is not None:
+            print(i.report())
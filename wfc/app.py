@@ -0,0 +1,371 @@
+"""Wave function collapse window"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+import numpy
+import pygame
+from solver import Solver, TileSet, domain_array, indices
+
+COLOUR_WHITE = (255,255,255)
+COLOUR_RED = (255,0,0)
+COLOUR_GREEN = (0,255,0)
+COLOUR_YELLOW = (255,255,0)
+COLOUR_ORANGE = (255,80,0)
+
+TILE_WIDTH = 32
+TILE_HEIGHT = 32
+
+class Snapshot():
+    """
+    Immutable view of the solver published by SolverThread
+    changes are (index, domain) pairs for the cells changed since
+    the last snapshot was taken, checked, changed and resolved
+    are cell indices from the last step
+    """
+    __slots__ = ('_changes', '_checked', '_changed', '_resolved', '_complete')
+    def __init__(self, changes: tuple, checked: tuple, changed: tuple, resolved: int,
+                 complete: bool) -> None:
+        self._changes = changes
+        self._checked = checked
+        self._changed = changed
+        self._resolved = resolved
+        self._complete = complete
+    @property
+    def changes(self) -> tuple[tuple[int, int], ...]:
+        """Get (index, domain) pairs of changed cells."""
+        return self._changes
+    @property
+    def checked(self) -> tuple[int, ...]:
+        """Get indices of cells checked in the last step."""
+        return self._checked
+    @property
+    def changed(self) -> tuple[int, ...]:
+        """Get indices of cells changed in the last step."""
+        return self._changed
+    @property
+    def resolved(self) -> int:
+        """Get index of the cell collapsed in the last step or None."""
+        return self._resolved
+    @property
+    def complete(self) -> bool:
+        """Check if the solver has finished."""
+        return self._complete
+
+class SolverThread(threading.Thread):
+    """
+    Steps the solver in a background thread
+    After each batch of steps the changed domains are merged into
+    a pending set under a lock, take() hands them to the renderer
+    as a Snapshot so the renderer never reads the solver itself
+    """
+    def __init__(self, solver: Solver, delay: float, budget: float) -> None:
+        super().__init__(name='solver', daemon=True)
+        self._solver = solver
+        self._delay = delay
+        self._budget = budget
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._pending = {}
+        self._last = ((), (), None)
+        self._complete = False
+        self._solver.track_dirty()
+    def stop(self) -> None:
+        """Ask the thread to stop after the current batch."""
+        self._stop_event.set()
+    def run(self) -> None:
+        complete = False
+        while not complete and not self._stop_event.is_set():
+            complete = step(self._solver, self._budget)
+            self._publish(complete)
+            if self._delay > 0:
+                self._stop_event.wait(self._delay)
+    def _publish(self, complete: bool) -> None:
+        """Merge the domains changed by the last batch into the pending set."""
+        changes = {index: self._solver.domain(index) for index in self._solver.take_dirty()}
+        resolved = self._solver.resolved_cell()
+        last = (tuple(cell.index for cell in self._solver.checked_cells()),
+                tuple(cell.index for cell in self._solver.changed_cells()),
+                resolved.index if resolved is not None else None)
+        with self._lock:
+            self._pending.update(changes)
+            self._last = last
+            self._complete = complete
+    def take(self) -> Snapshot:
+        """Get a snapshot of the changes since the last call."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            last = self._last
+            complete = self._complete
+        return Snapshot(tuple(pending.items()), *last, complete)
+
+def step(solver: Solver, budget: float) -> bool:
+    """
+    Step the solver for up to budget milliseconds, at least once
+    Returns True if the solver has finished
+    """
+    deadline = time.perf_counter() + budget / 1000
+    while True:
+        if solver.solve():
+            return True
+        if time.perf_counter() >= deadline:
+            return False
+
+class ImageCache():
+    """
+    Least recently used cache of blended images of undecided cells
+    keyed by domain mask, images are the average of a stack of the
+    tile pixels, weighted by tile weight if weighted
+    """
+    def __init__(self, tileset: TileSet, capacity: int = 1024, weighted: bool = False) -> None:
+        if capacity < 1:
+            raise ValueError('image cache must hold at least one image')
+        self._tileset = tileset
+        self._capacity = capacity
+        self._weighted = weighted
+        # most recently used last
+        self._images = OrderedDict()
+        self._stack = None
+        self._weights = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+    def __len__(self) -> int:
+        return len(self._images)
+    @property
+    def hits(self) -> int:
+        """Get number of images found in the cache."""
+        return self._hits
+    @property
+    def misses(self) -> int:
+        """Get number of images blended."""
+        return self._misses
+    @property
+    def evictions(self) -> int:
+        """Get number of images dropped to stay within capacity."""
+        return self._evictions
+    def get(self, domain: int) -> pygame.Surface:
+        """Get or blend image for the tiles in domain."""
+        image = self._images.get(domain)
+        if image is not None:
+            self._images.move_to_end(domain)
+            self._hits += 1
+            return image
+        self._misses += 1
+        image = self.blend(domain)
+        self._images[domain] = image
+        if len(self._images) > self._capacity:
+            self._images.popitem(last=False)
+            self._evictions += 1
+        return image
+    def blend(self, domain: int) -> pygame.Surface:
+        """Get the weighted average of the images of the tiles in domain."""
+        if self._stack is None:
+            names = self._tileset.names()
+            # (tile, x, y, rgb)
+            self._stack = numpy.stack([pygame.surfarray.array3d(self._tileset.image(name))
+                                       for name in names]).astype(numpy.float32)
+            if self._weighted:
+                self._weights = numpy.array([self._tileset.weight(name) for name in names],
+                                            dtype=numpy.float32)
+            else:
+                self._weights = numpy.ones(len(names), dtype=numpy.float32)
+        tiles = indices(domain)
+        weights = self._weights[tiles]
+        pixels = numpy.tensordot(weights / weights.sum(), self._stack[tiles], axes=1)
+        return pygame.surfarray.make_surface(pixels.astype(numpy.uint8))
+
+class App():
+    """
+    Wave function collapse application
+    The grid is drawn into a back buffer, only the cells the solver
+    reports as changed are redrawn and only their rects are updated
+    With threaded the solver runs in a SolverThread and the App
+    draws from the snapshots it publishes
+    """
+    def __init__(self, solver: Solver, delay: float, shownumbers: bool, showchanged: bool,
+                 budget: float = 0, fps: int = 60, threaded: bool = False,
+                 image_cache: int = 1024, weighted: bool = False) -> None:
+        self._solver = solver
+        self._delay = delay
+        self._shownumbers = shownumbers
+        self._showchanged = showchanged
+        self._budget = budget
+        self._fps = fps
+
+        self._running = True
+        self._display_surf = None
+        self._grid_surf = None
+        self._clock = None
+        self._width = TILE_WIDTH * self._solver.width
+        self._height = TILE_HEIGHT * self._solver.height
+        self._size = (self._width, self._height)
+        self._counter = 0
+        self._complete = False
+        self._stepped = False
+        self.font_s = None
+        self.font_l = None
+        self._digits = []
+        self._labels = []
+        # rects drawn over the grid last frame, put back from the back buffer
+        self._overlay_rects = []
+        # domains as last drawn, the solver may be ahead when threaded
+        self._domains = domain_array(solver.width * solver.height,
+                                     len(solver.tileset.names()), solver.tileset.full())
+        self._last = ((), (), None)
+
+        self._image_cache = ImageCache(solver.tileset, image_cache, weighted)
+        self._thread = None
+        if threaded:
+            self._thread = SolverThread(solver, delay, budget)
+        else:
+            self._solver.track_dirty()
+    def on_init(self) -> bool:
+        """On init"""
+        pygame.init()
+        pygame.display.set_caption("Solver (Seed:%i)" % self._solver.seed)
+        self._display_surf = pygame.display.set_mode(self._size,
+                                                     pygame.HWSURFACE | pygame.DOUBLEBUF)
+        self._clock = pygame.time.Clock()
+        self._running = True
+        #self.font = pygame.font.SysFont('courier.ttf', 72)
+        font_name = pygame.font.get_default_font()
+        logging.info("System font: %s", font_name)
+        self.font_s = pygame.font.SysFont(None, 22)
+        self.font_l = pygame.font.SysFont(None, 33)
+        # text that does not change is rendered once
+        self._digits = [self.font_l.render(str(n), True, (0,0,0))
+                        for n in range(0, len(self._solver.tileset.names()) + 1)]
+        self._labels = [
+            (self.font_s.render('checked cells', True, COLOUR_GREEN), (10, 10)),
+            (self.font_s.render('changed cells', True, COLOUR_ORANGE), (10, 30)),
+            (self.font_s.render('resolved cell', True, COLOUR_YELLOW), (10, 50))
+        ]
+        self._grid_surf = pygame.Surface(self._size)
+        self._grid_surf.fill(COLOUR_WHITE)
+        if self._thread is None:
+            self._solver.take_dirty()
+        for index in range(0, self._solver.width * self._solver.height):
+            self._domains[index] = self._solver.domain(index)
+            self.draw_cell(index)
+        self._display_surf.blit(self._grid_surf, (0, 0))
+        pygame.display.update()
+        if self._thread is not None:
+            self._thread.start()
+        return True
+    def on_event(self, event: pygame.event.Event) -> None:
+        """On event"""
+        if event.type == pygame.QUIT:
+            self._running = False
+        elif event.type == pygame.KEYDOWN:
+            if event.key == 27:
+                self._running = False
+        else:
+            logging.debug(event)
+    def on_loop(self, elapsed: float) -> None:
+        """On loop"""
+        if self._thread is not None:
+            return
+        self._counter+=elapsed
+        if self._counter > self._delay:
+            logging.info("tick")
+            self._counter = 0
+            if not self._complete:
+                self._stepped = True
+                if step(self._solver, self._budget):
+                    self._complete = True
+    def cell_rect(self, index: int) -> pygame.Rect:
+        """Get screen rect of cell at index"""
+        row, col = divmod(index, self._solver.width)
+        return pygame.Rect(col*TILE_WIDTH, row*TILE_HEIGHT, TILE_WIDTH, TILE_HEIGHT)
+    def draw_cell(self, index: int) -> pygame.Rect:
+        """Draw cell at index into the back buffer"""
+        rect = self.cell_rect(index)
+        domain = self._domains[index]
+        num_choices = domain.bit_count()
+        if num_choices == 0:
+            pygame.draw.rect(self._grid_surf, COLOUR_RED, rect)
+        elif num_choices == 1:
+            tile_name = self._solver.tileset.names()[domain.bit_length() - 1]
+            self._grid_surf.blit(self._solver.tileset.image(tile_name), rect)
+        elif self._shownumbers:
+            self._grid_surf.fill(COLOUR_WHITE, rect)
+            self._grid_surf.blit(self._digits[num_choices], (rect.x+3, rect.y+6))
+        else:
+            self._grid_surf.blit(self._image_cache.get(domain), rect)
+        return rect
+    def take_changes(self) -> list[int]:
+        """Copy the domains changed since the last frame, get their indices"""
+        if self._thread is not None:
+            snapshot = self._thread.take()
+            for index, domain in snapshot.changes:
+                self._domains[index] = domain
+            if len(snapshot.changes) > 0:
+                self._stepped = True
+                self._last = (snapshot.checked, snapshot.changed, snapshot.resolved)
+            if snapshot.complete != self._complete:
+                self._stepped = True
+                self._complete = snapshot.complete
+            return [index for index, _ in snapshot.changes]
+        dirty = self._solver.take_dirty()
+        for index in dirty:
+            self._domains[index] = self._solver.domain(index)
+        resolved = self._solver.resolved_cell()
+        self._last = ([cell.index for cell in self._solver.checked_cells()],
+                      [cell.index for cell in self._solver.changed_cells()],
+                      resolved.index if resolved is not None else None)
+        return dirty
+    def on_render(self) -> None:
+        """Render the cells changed since the last frame"""
+        dirty = self.take_changes()
+        if not self._stepped and len(dirty) == 0:
+            return
+        self._stepped = False
+        rects = [self.draw_cell(index) for index in dirty]
+        # put back what the overlays covered last frame
+        rects.extend(self._overlay_rects)
+        for rect in rects:
+            self._display_surf.blit(self._grid_surf, rect, rect)
+        self._overlay_rects = []
+        if self._complete is False:
+            if self._showchanged:
+                checked, changed, resolved = self._last
+                for index in checked:
+                    self.draw_overlay_rect(index, COLOUR_GREEN)
+                for index in changed:
+                    self.draw_overlay_rect(index, COLOUR_ORANGE)
+                if resolved is not None:
+                    self.draw_overlay_rect(resolved, COLOUR_YELLOW)
+                    for text, position in self._labels:
+                        self._overlay_rects.append(self._display_surf.blit(text, position))
+            text = self.font_s.render('images cached: {0} hits: {1} misses: {2} evictions: {3}'.format(
+                len(self._image_cache), self._image_cache.hits, self._image_cache.misses,
+                self._image_cache.evictions), True, COLOUR_RED)
+            self._overlay_rects.append(self._display_surf.blit(text, (10, self._height - 20)))
+        rects.extend(self._overlay_rects)
+        pygame.display.update(rects)
+    def draw_overlay_rect(self, index: int, colour: tuple) -> None:
+        """Outline cell at index on the display, to be put back next frame"""
+        rect = self.cell_rect(index)
+        pygame.draw.rect(self._display_surf, colour, rect, 3)
+        self._overlay_rects.append(rect)
+    def on_cleanup(self) -> None:
+        """On cleanup"""
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread.join()
+        pygame.quit()
+    def on_execute(self) -> None:
+        """On execute"""
+        if not self.on_init():
+            self._running = False
+        while self._running:
+            # caps the frame rate, elapsed is in milliseconds
+            elapsed = self._clock.tick(self._fps) / 1000
+            for event in pygame.event.get():
+                self.on_event(event)
+            self.on_loop(elapsed)
+            self.on_render()
+        self.on_cleanup()
@@ -0,0 +1,288 @@
+"""Headless batch generation"""
+
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import solver
+
+# set in each worker process by _init_worker
+_tileset = None
+_options = None
+_checkpoint = None
+_every = 0
+_stop = None
+
+# steps between checks of the stop event in a race
+RACE_CHECK = 64
+
+def parse_size(size: str) -> tuple[int, int]:
+    """Parse WIDTHxHEIGHT into (width, height)."""
+    try:
+        width, height = (int(part) for part in size.lower().split('x'))
+    except ValueError as ex:
+        raise ValueError('size must be WIDTHxHEIGHT, got {0}'.format(size)) from ex
+    if width < 1 or height < 1:
+        raise ValueError('size must be at least 1x1, got {0}'.format(size))
+    return (width, height)
+
+def seeds(seed: int, count: int) -> list[int]:
+    """
+    Get count seeds, the first is seed itself
+    and the rest are derived from it
+    """
+    if count < 1:
+        return []
+    if seed is None:
+        seed = random.randrange(sys.maxsize)
+    return [seed] + [solver.derive_seed(seed, i) for i in range(1, count)]
+
+def percentile(values: list[float], percent: float) -> float:
+    """Get nearest rank percentile of values."""
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def _init_worker(tileset: solver.TileSet, options: dict, checkpoint: str = None, every: int = 0) -> None:
+    """Keep the tileset, options and checkpoint settings for each worker process."""
+    global _tileset, _options, _checkpoint, _every # pylint: disable=global-statement
+    _tileset = tileset
+    _options = options
+    _checkpoint = checkpoint
+    _every = every
+
+def _solve(job: tuple[int, int]) -> dict:
+    """Solve one map, job is (index, seed)."""
+    index, seed = job
+    start = time.perf_counter()
+    s = None
+    path = None
+    if _checkpoint is not None:
+        path = os.path.join(_checkpoint, '{0:06d}.checkpoint'.format(index))
+        if os.path.exists(path):
+            try:
+                s = solver.Solver.resume(path, _tileset, _options.get('instrument'))
+            except ValueError as ex:
+                logging.warning('not resuming map %i: %s', index, ex)
+            if s is not None and s.seed != seed:
+                s = None
+    if s is None:
+        s = solver.Solver(_tileset, seed, **_options)
+    clean = s.run(path, _every)
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+    return {
+        'index': index,
+        'seed': seed,
+        'grid': s.tile_grid(),
+        'time': time.perf_counter() - start,
+        'clean': clean,
+        'contradictions': s.contradictions,
+        'backtracks': s.backtracks,
+        'restarts': s.restarts
+    }
+
+def _init_racer(tileset: solver.TileSet, options: dict, stop) -> None:
+    """Keep the tileset, options and the event that stops the race for each worker process."""
+    global _tileset, _options, _stop # pylint: disable=global-statement
+    _tileset = tileset
+    _options = options
+    _stop = stop
+
+def _race(job: tuple[int, int]) -> dict:
+    """Solve one map of a race, giving up when another worker has won, job is (index, seed)."""
+    index, seed = job
+    start = time.perf_counter()
+    s = solver.Solver(_tileset, seed, **_options)
+    cancelled = False
+    while not s.solve():
+        if s.steps % RACE_CHECK == 0 and _stop is not None and _stop.is_set():
+            cancelled = True
+            break
+    clean = not cancelled and not s.gave_up and s.contradiction_free()
+    return {
+        'index': index,
+        'seed': seed,
+        'grid': s.tile_grid() if not cancelled else None,
+        'time': time.perf_counter() - start,
+        'steps': s.steps,
+        'clean': clean,
+        'cancelled': cancelled,
+        'contradictions': s.contradictions
+    }
+
+def map_record(result: dict, names: list[str], options: dict) -> dict:
+    """Get the json record for a solved map."""
+    return {
+        'seed': result['seed'],
+        'width': options['width'],
+        'height': options['height'],
+        'wrap': options['wrap'],
+        'tiles': names,
+        'grid': result['grid']
+    }
+
+class Writer():
+    """Writes maps to a directory, one file each, or to a single json lines file."""
+    def __init__(self, output: str, combined: bool, names: list[str], options: dict) -> None:
+        self._output = output
+        self._combined = combined
+        self._names = names
+        self._options = options
+        self._file = None
+        if combined:
+            directory = os.path.dirname(output)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(output, 'w', encoding='utf-8') # pylint: disable=consider-using-with
+        else:
+            os.makedirs(output, exist_ok=True)
+    def write(self, result: dict) -> None:
+        """Write one solved map."""
+        record = map_record(result, self._names, self._options)
+        if self._combined:
+            self._file.write(json.dumps(record, separators=(',', ':')))
+            self._file.write('\n')
+        else:
+            path = os.path.join(self._output, '{0:06d}.json'.format(result['index']))
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(record, file, separators=(',', ':'))
+    def close(self) -> None:
+        """Close the combined file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def _collect(results, writer: Writer, times: list[float], summary: dict) -> None:
+    """Write results as they arrive and add them to the summary."""
+    for result in results:
+        writer.write(result)
+        times.append(result['time'])
+        summary['maps'] += 1
+        summary['clean'] += result['clean']
+        summary['contradictions'] += result['contradictions']
+        summary['backtracks'] += result['backtracks']
+        summary['restarts'] += result['restarts']
+
+def generate(tileset: solver.TileSet, count: int, output: str, combined=False, jobs: int = None,
+             seed: int = None, checkpoint: str = None, every: int = 0, **options) -> dict:
+    """
+    Solve count maps across jobs worker processes and write them to output
+    options are passed to each Solver (wrap, width, height, recovery...)
+    With checkpoint each map in progress is saved to that directory
+    every that many steps and resumed from there by the next run
+    Returns a summary of the run
+    """
+    options.setdefault('wrap', False)
+    options.setdefault('width', solver.TILE_X)
+    options.setdefault('height', solver.TILE_Y)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, count))
+    if options.get('instrument') is not None and jobs > 1:
+        # every map adds to the one instrument so they are solved in this process
+        logging.warning('instrumented runs use one job')
+        jobs = 1
+    map_seeds = seeds(seed, count)
+    logging.info('generating %i maps with %i jobs', count, jobs)
+    if checkpoint is not None:
+        os.makedirs(checkpoint, exist_ok=True)
+    writer = Writer(output, combined, tileset.names(), options)
+    times = []
+    summary = {'maps': 0, 'clean': 0, 'contradictions': 0, 'backtracks': 0, 'restarts': 0}
+    start = time.perf_counter()
+    try:
+        if jobs == 1:
+            _init_worker(tileset, options, checkpoint, every)
+            _collect(map(_solve, enumerate(map_seeds)), writer, times, summary)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(tileset, options, checkpoint, every)) as executor:
+                results = executor.map(_solve, enumerate(map_seeds),
+                                       chunksize=max(1, count // (jobs * 8)))
+                _collect(results, writer, times, summary)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    summary['seconds'] = elapsed
+    summary['maps_per_second'] = summary['maps'] / elapsed if elapsed > 0 else 0.0
+    summary['p50'] = percentile(times, 50)
+    summary['p99'] = percentile(times, 99)
+    return summary
+
+def race(tileset: solver.TileSet, count: int, jobs: int = None, seed: int = None, **options) -> dict:
+    """
+    Solve the same map with count seeds across jobs worker processes
+    and take the first with no contradictions, the others are stopped
+    as soon as it is found and seeds not started yet are dropped
+    Returns the winning result (or the one with the fewest contradictions
+    if none is clean) with the cost of the others
+    """
+    options.setdefault('wrap', False)
+    options.setdefault('width', solver.TILE_X)
+    options.setdefault('height', solver.TILE_Y)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, count))
+    race_seeds = seeds(seed, count)
+    if len(race_seeds) == 0:
+        raise ValueError('race needs at least one seed')
+    logging.info('racing %i seeds with %i jobs', count, jobs)
+    results = []
+    start = time.perf_counter()
+    if jobs == 1:
+        _init_racer(tileset, options, None)
+        for job in enumerate(race_seeds):
+            results.append(_race(job))
+            if results[-1]['clean']:
+                break
+    else:
+        stop = multiprocessing.Event()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_racer,
+                                 initargs=(tileset, options, stop)) as executor:
+            pending = {executor.submit(_race, job) for job in enumerate(race_seeds)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if not future.cancelled():
+                        results.append(future.result())
+                if any(result['clean'] for result in results) and not stop.is_set():
+                    stop.set()
+                    for future in pending:
+                        future.cancel()
+    elapsed = time.perf_counter() - start
+    clean = [result for result in results if result['clean']]
+    if clean:
+        winner = min(clean, key=lambda result: result['time'])
+    else:
+        winner = min((result for result in results if not result['cancelled']),
+                     key=lambda result: result['contradictions'])
+    losers = [result for result in results if result is not winner]
+    winner = dict(winner)
+    winner['seconds'] = elapsed
+    winner['started'] = len(results)
+    winner['cancelled'] = sum(result['cancelled'] for result in losers)
+    winner['loser_steps'] = sum(result['steps'] for result in losers)
+    winner['loser_time'] = sum(result['time'] for result in losers)
+    return winner
+
+def format_race(result: dict) -> str:
+    """Format a result from race for printing."""
+    return ('{state} with seed {seed} after {time:.2f}s ({seconds:.2f}s wall), {started} started, '
+            '{cancelled} cancelled, losers took {loser_steps} steps in {loser_time:.2f}s').format(
+                state='clean' if result['clean'] else 'no clean map, fewest contradictions', **result)
+
+def format_summary(summary: dict) -> str:
+    """Format a summary from generate for printing."""
+    return ('{maps} maps in {seconds:.2f}s ({maps_per_second:.2f} maps/s), {clean} clean, '
+            '{contradictions} contradictions, {backtracks} backtracks, {restarts} restarts, '
+            'solve time p50 {p50_ms:.1f}ms p99 {p99_ms:.1f}ms').format(
+                p50_ms=summary['p50'] * 1000, p99_ms=summary['p99'] * 1000, **summary)
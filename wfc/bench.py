@@ -0,0 +1,177 @@
+"""Solver benchmarks"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+import batch
+from instrument import Instrument
+import solver
+import tileset
+
+SIZES = (20, 64, 256)
+SEED = 1
+SEED_COUNT = 3
+
+# 1 if a higher value is better, -1 if lower is better
+METRICS = {
+    'collapses_per_second': 1,
+    'visits_per_collapse': -1,
+    'contradiction_rate': -1,
+    'peak_memory': -1,
+    'seconds': -1
+}
+
+def case_name(size: int, wrap: bool) -> str:
+    """Get name of the benchmark case for a grid size."""
+    return '{0}x{0}{1}'.format(size, '-wrap' if wrap else '')
+
+def peak_memory(tiles: solver.TileSet, seed: int, wrap: bool, size: int, **options) -> int:
+    """Get peak bytes allocated while solving one map."""
+    tracemalloc.start()
+    try:
+        solver.Solver(tiles, seed, wrap, width=size, height=size, **options).run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(tiles: solver.TileSet, seeds: list[int], wrap: bool, size: int,
+            memory: bool = True, **options) -> dict:
+    """
+    Solve a map for each seed and get the metrics for the case
+    Only the time spent in solver steps counts towards collapses per second,
+    peak memory is taken from a separate traced run of the first seed
+    """
+    counters = Instrument()
+    contradicted = 0
+    start = time.perf_counter()
+    for seed in seeds:
+        s = solver.Solver(tiles, seed, wrap, width=size, height=size, instrument=counters, **options)
+        s.run()
+        if s.contradictions > 0:
+            contradicted += 1
+    elapsed = time.perf_counter() - start
+    collapses = counters.collapses
+    visits = counters.visits
+    solving = sum(counters.times.values())
+    return {
+        'maps': len(seeds),
+        'collapses': collapses,
+        'collapses_per_second': collapses / solving if solving > 0 else 0.0,
+        'visits_per_collapse': visits / collapses if collapses > 0 else 0.0,
+        'contradiction_rate': contradicted / len(seeds) if len(seeds) > 0 else 0.0,
+        'peak_memory': peak_memory(tiles, seeds[0], wrap, size, **options) if memory else 0,
+        'seconds': elapsed
+    }
+
+def run(tiles: solver.TileSet, sizes=SIZES, seed: int = SEED, count: int = SEED_COUNT,
+        memory: bool = True, **options) -> dict:
+    """
+    Run every case, each size with and without wrap, over the same count seeds
+    options are passed to each Solver (propagation, entropy, recovery...)
+    """
+    seeds = batch.seeds(seed, count)
+    cases = {}
+    for size in sizes:
+        for wrap in (False, True):
+            name = case_name(size, wrap)
+            logging.info('benchmark %s', name)
+            cases[name] = measure(tiles, seeds, wrap, size, memory, **options)
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'tiles': len(tiles.names()),
+        'seeds': seeds,
+        'options': {key: str(value) for key, value in options.items()},
+        'cases': cases
+    }
+
+def compare(baseline: dict, current: dict, threshold: float = 10.0) -> list[str]:
+    """
+    Get the metrics of current that are more than threshold percent
+    worse than in baseline, for the cases in both
+    """
+    regressions = []
+    for name, case in current['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        for metric, better in METRICS.items():
+            if metric not in base or metric not in case:
+                continue
+            old = base[metric]
+            new = case[metric]
+            if old != 0:
+                change = (new - old) / old * 100
+            else:
+                change = 0.0 if new == old else float('inf')
+            if -change * better > threshold:
+                regressions.append('{0} {1}: {2:.4g} -> {3:.4g} ({4:+.1f}%)'.format(
+                    name, metric, old, new, change))
+    return regressions
+
+def format_results(results: dict) -> str:
+    """Format the cases from run for printing."""
+    lines = []
+    for name, case in results['cases'].items():
+        lines.append(('{0:>14} {collapses_per_second:10.0f} collapses/s {visits_per_collapse:6.2f} visits/collapse '
+                      '{contradiction_rate:5.2f} contradiction rate {peak_memory:11d} peak bytes '
+                      '{seconds:7.2f}s').format(name, **case))
+    return '\n'.join(lines)
+
+def parse_sizes(sizes: str) -> list[int]:
+    """Parse comma separated grid sizes."""
+    try:
+        result = [int(size) for size in sizes.split(',')]
+    except ValueError as ex:
+        raise ValueError('sizes must be comma separated numbers, got {0}'.format(sizes)) from ex
+    if any(size < 1 for size in result):
+        raise ValueError('sizes must be at least 1, got {0}'.format(sizes))
+    return result
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the run and compare commands to parser."""
+    commands = parser.add_subparsers(dest='bench_command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks and write the results as json')
+    run_parser.add_argument('--sizes', type=parse_sizes, required=False, default=list(SIZES), dest='sizes')
+    run_parser.add_argument('-n', '--count', type=int, required=False, default=SEED_COUNT, dest='count')
+    run_parser.add_argument('--nomemory', required=False, default=False, dest='nomemory', action='store_true')
+    run_parser.add_argument('-o', '--output', type=str, required=False, default=None, dest='output')
+    compare_parser = commands.add_parser('compare', help='compare results with a baseline')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float, required=False, default=10.0, dest='threshold')
+
+def main(args: argparse.Namespace, tiles: solver.TileSet, **options) -> int:
+    """Run a bench command, returns the exit status."""
+    if args.bench_command == 'run':
+        results = run(tiles, args.sizes, args.seed if args.seed is not None else SEED, args.count,
+                      not args.nomemory, **options)
+        print(format_results(results))
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2)
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    with open(args.current, 'r', encoding='utf-8') as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    for regression in regressions:
+        print(regression)
+    if len(regressions) == 0:
+        print('no regressions over {0}%'.format(args.threshold))
+        return 0
+    return 1
+
+if __name__ == '__main__':
+    script_parser = argparse.ArgumentParser(description='solver benchmarks')
+    script_parser.add_argument('-s', '--seed', type=int, required=False, default=None, dest='seed')
+    script_parser.add_argument('--tileset', type=str, required=False, default=tileset.DEFAULT_PATH, dest='tileset')
+    add_arguments(script_parser)
+    script_args = script_parser.parse_args()
+    sys.exit(main(script_args, tileset.load(script_args.tileset)))
@@ -0,0 +1,93 @@
+"""Map image export"""
+
+import json
+import struct
+import zlib
+import numpy
+import pygame
+import solver
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# colour of a cell with no tile
+COLOUR_EMPTY = (255, 0, 0)
+
+def atlas(tileset: solver.TileSet) -> numpy.ndarray:
+    """
+    Get the tile images stacked as (tile, y, x, rgb) with one more
+    entry after the last tile, filled with COLOUR_EMPTY, for cells with no tile
+    """
+    images = [pygame.surfarray.array3d(tileset.image(name)).transpose(1, 0, 2) for name in tileset.names()]
+    empty = numpy.empty_like(images[0])
+    empty[:, :] = COLOUR_EMPTY
+    images.append(empty)
+    return numpy.stack(images).astype(numpy.uint8)
+
+def tile_indices(record: dict, tileset: solver.TileSet) -> numpy.ndarray:
+    """
+    Get the grid of a map record as atlas indices by row, the record's
+    tile names are matched to the tileset and -1 becomes the empty entry
+    """
+    try:
+        lookup = [tileset.index(name) for name in record['tiles']]
+    except KeyError as ex:
+        raise ValueError('map uses tile {0} which is not in the tileset'.format(ex)) from ex
+    lookup.append(len(tileset.names()))
+    return numpy.array(lookup, dtype=numpy.intp)[numpy.array(record['grid'], dtype=numpy.intp)]
+
+def render(grid: numpy.ndarray, tiles: numpy.ndarray) -> numpy.ndarray:
+    """Get the image (y, x, rgb) of a grid of atlas indices."""
+    rows, cols = grid.shape
+    _, tile_height, tile_width, _ = tiles.shape
+    # (row, col, y, x, rgb) to (row, y, col, x, rgb)
+    return tiles[grid].transpose(0, 2, 1, 3, 4).reshape(rows * tile_height, cols * tile_width, 3)
+
+def strips(grid: numpy.ndarray, tiles: numpy.ndarray):
+    """Yield the image a row of tiles at a time."""
+    for row in range(0, grid.shape[0]):
+        yield render(grid[row:row + 1], tiles)
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    """Get a png chunk."""
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def write_png(path: str, grid: numpy.ndarray, tiles: numpy.ndarray, level: int = 6) -> None:
+    """Write the image of grid as an rgb png, compressing a row of tiles at a time."""
+    _, tile_height, tile_width, _ = tiles.shape
+    width = grid.shape[1] * tile_width
+    height = grid.shape[0] * tile_height
+    compressor = zlib.compressobj(level)
+    with open(path, 'wb') as file:
+        file.write(PNG_SIGNATURE)
+        file.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for strip in strips(grid, tiles):
+            # each scanline starts with filter type 0
+            lines = numpy.zeros((strip.shape[0], width * 3 + 1), dtype=numpy.uint8)
+            lines[:, 1:] = strip.reshape(strip.shape[0], width * 3)
+            data = compressor.compress(lines.tobytes())
+            if data:
+                file.write(_chunk(b'IDAT', data))
+        file.write(_chunk(b'IDAT', compressor.flush()))
+        file.write(_chunk(b'IEND', b''))
+
+def write_raw(path: str, grid: numpy.ndarray, tiles: numpy.ndarray) -> None:
+    """Write the image of grid as raw rgb bytes, a row of tiles at a time."""
+    with open(path, 'wb') as file:
+        for strip in strips(grid, tiles):
+            file.write(strip.tobytes())
+
+def export(map_path: str, output: str, tileset: solver.TileSet) -> tuple[int, int]:
+    """
+    Write the image of a map written by generate or world to output,
+    raw rgb if output ends in .raw otherwise png
+    Returns (width, height) of the image in pixels
+    """
+    with open(map_path, 'r', encoding='utf-8') as file:
+        record = json.loads(file.readline() if map_path.endswith('.jsonl') else file.read())
+    grid = tile_indices(record, tileset)
+    tiles = atlas(tileset)
+    if output.endswith('.raw'):
+        write_raw(output, grid, tiles)
+    else:
+        write_png(output, grid, tiles)
+    return (grid.shape[1] * tiles.shape[2], grid.shape[0] * tiles.shape[1])
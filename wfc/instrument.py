@@ -0,0 +1,101 @@
+"""Solver instrumentation"""
+
+import cProfile
+import io
+import pstats
+import time
+
+# phases of a solver step, timed from the switch into them to the next switch
+PHASES = ('select', 'propagate', 'recover')
+
+INSTRUMENTS = ('counters', 'profile')
+
+class Instrument():
+    """
+    Counts solver steps, collapses, cell visits and narrowed cells
+    and times each phase of a step with perf_counter
+    With trace the cells visited and narrowed in the last step are kept
+    A solver without an instrument skips all of this
+    """
+    def __init__(self, trace: bool = False) -> None:
+        self._trace = trace
+        self.steps = 0
+        self.collapses = 0
+        self.visits = 0
+        self.narrowed = 0
+        self.times = {phase: 0.0 for phase in PHASES}
+        # cells visited and narrowed in the last step, kept with trace
+        self.checked = []
+        self.changed = []
+        self._phase = None
+        self._since = 0.0
+    @property
+    def trace(self) -> bool:
+        """Check if visited cells are kept."""
+        return self._trace
+    def start_step(self) -> None:
+        """Start timing a step, in the select phase."""
+        self.steps += 1
+        if self._trace:
+            self.checked.clear()
+            self.changed.clear()
+        self._phase = 'select'
+        self._since = time.perf_counter()
+    def switch(self, phase: str) -> None:
+        """Add the time since the last switch to the current phase and move to phase."""
+        now = time.perf_counter()
+        self.times[self._phase] += now - self._since
+        self._phase = phase
+        self._since = now
+    def end_step(self, collapsed: bool) -> None:
+        """Stop timing a step."""
+        self.times[self._phase] += time.perf_counter() - self._since
+        self.collapses += collapsed
+    def visit(self, index: int) -> None:
+        """Count a cell checked during propagation."""
+        self.visits += 1
+        if self._trace:
+            self.checked.append(index)
+    def narrow(self, index: int) -> None:
+        """Count a cell that lost choices during propagation."""
+        self.narrowed += 1
+        if self._trace:
+            self.changed.append(index)
+    def report(self) -> str:
+        """Format counters and phase times for printing."""
+        per_collapse = self.visits / self.collapses if self.collapses > 0 else 0.0
+        lines = [
+            '{0} steps, {1} collapses, {2} visits ({3:.2f} per collapse), {4} narrowed'.format(
+                self.steps, self.collapses, self.visits, per_collapse, self.narrowed),
+            ', '.join('{0} {1:.3f}s'.format(phase, self.times[phase]) for phase in PHASES)
+        ]
+        return '\n'.join(lines)
+
+class Profiler(Instrument):
+    """Instrument that also runs cProfile during each step."""
+    def __init__(self, trace: bool = False, limit: int = 25) -> None:
+        super().__init__(trace)
+        self._limit = limit
+        self._profile = cProfile.Profile()
+    def start_step(self) -> None:
+        super().start_step()
+        self._profile.enable()
+    def end_step(self, collapsed: bool) -> None:
+        self._profile.disable()
+        super().end_step(collapsed)
+    def report(self) -> str:
+        """Format counters, phase times and the most expensive functions."""
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self._limit)
+        return '{0}\n{1}'.format(super().report(), stream.getvalue())
+
+def create(kind: str = None, trace: bool = False) -> Instrument:
+    """Get an instrument of kind (counters, profile), None if not kind and not trace."""
+    if kind == 'profile':
+        return Profiler(trace)
+    if kind == 'counters' or trace:
+        return Instrument(trace)
+    if kind is not None:
+        raise ValueError('unknown instrument {0}'.format(kind))
+    return None
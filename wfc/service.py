@@ -0,0 +1,352 @@
+"""Local map generation service"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import batch
+import solver
+import tileset
+
+# largest request body and number of latencies kept for the stats
+MAX_BODY = 1 << 20
+LATENCY_WINDOW = 1000
+TILESET_CACHE = 64
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    422: 'Unprocessable Entity',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+class RequestError(Exception):
+    """Request that gets an error response."""
+    def __init__(self, status: int, message: str, **details) -> None:
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+def _load(definition) -> solver.TileSet:
+    """Load a tileset in a worker process from a definition file path or an inline definition."""
+    if isinstance(definition, str):
+        return tileset.load(definition)
+    return solver.TileSet(tileset.parse(definition))
+
+def _solve(job: tuple[solver.TileSet, int, dict]) -> bytes:
+    """Solve one map in a worker process and get its json record, job is (tileset, seed, options)."""
+    tiles, seed, options = job
+    start = time.perf_counter()
+    s = solver.Solver(tiles, seed, **options)
+    clean = s.run()
+    record = batch.map_record({'seed': seed, 'grid': s.tile_grid()}, tiles.names(), options)
+    record['clean'] = clean
+    record['contradictions'] = s.contradictions
+    record['time'] = time.perf_counter() - start
+    return json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+class Service():
+    """
+    Solves maps for json requests in a pool of jobs worker processes
+    Finished maps are kept in an LRU of cache_size maps keyed by the
+    tileset digest and the request, a request matching one still being
+    solved waits for that solve, and at most queue solves are waiting
+    or running at once
+    tiles, size and wrap are used for requests that do not give them,
+    requests for maps wider or taller than max_size are rejected,
+    requests may name tileset files in tileset_dir (none if it is None)
+    or give inline definitions, both are loaded in the pool and the
+    last TILESET_CACHE kept,
+    options are passed to each Solver (propagation, entropy, recovery...)
+    """
+    def __init__(self, tiles: solver.TileSet, jobs: int = None, cache_size: int = 256, queue: int = 64,
+                 size: tuple[int, int] = (solver.TILE_X, solver.TILE_Y), wrap: bool = False,
+                 max_size: tuple[int, int] = (1024, 1024), tileset_dir: str = None, **options) -> None:
+        if cache_size < 0:
+            raise ValueError('cache size must not be negative')
+        if queue < 1:
+            raise ValueError('queue must hold at least one solve')
+        self._tileset = tiles
+        self._jobs = jobs if jobs is not None else os.cpu_count() or 1
+        self._cache_size = cache_size
+        self._queue = queue
+        self._size = size
+        self._wrap = wrap
+        self._max_size = max_size
+        self._tileset_dir = os.path.realpath(tileset_dir) if tileset_dir is not None else None
+        self._options = options
+        self._executor = None
+        # most recently used last
+        self._cache = OrderedDict()
+        # (future, pool) of solves not finished yet keyed like the cache
+        self._in_flight = {}
+        # (future, pool) of tilesets loaded or loading keyed by (path, modified time) for files and
+        # by the hash of the definition for inline ones, most recently used last
+        self._tilesets = OrderedDict()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._solve_times = deque(maxlen=LATENCY_WINDOW)
+        self._stats = {'requests': 0, 'hits': 0, 'misses': 0, 'coalesced': 0, 'rejected': 0, 'errors': 0,
+                       'broken_pools': 0}
+    def close(self) -> None:
+        """Stop worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+    def stats(self) -> dict:
+        """Get request counts, queue depth, cache size and latency percentiles in seconds."""
+        latencies = list(self._latencies)
+        solve_times = list(self._solve_times)
+        return dict(self._stats, **{
+            'queue_depth': len(self._in_flight),
+            'queue_limit': self._queue,
+            'jobs': self._jobs,
+            'cached': len(self._cache),
+            'latency_p50': batch.percentile(latencies, 50),
+            'latency_p99': batch.percentile(latencies, 99),
+            'solve_p50': batch.percentile(solve_times, 50),
+            'solve_p99': batch.percentile(solve_times, 99)
+        })
+    def _tileset_key(self, definition) -> tuple:
+        """Get (key, definition) for the tileset of a request, the definition with a file path resolved."""
+        if isinstance(definition, dict):
+            text = json.dumps(definition, sort_keys=True, separators=(',', ':'))
+            return (hashlib.sha256(text.encode('utf-8')).hexdigest(), definition)
+        if not isinstance(definition, str):
+            raise RequestError(400, 'tileset must be a definition file path or a definition')
+        if self._tileset_dir is None:
+            raise RequestError(400, 'tileset files are not served, give an inline definition')
+        try:
+            path = os.path.realpath(os.path.join(self._tileset_dir, definition))
+            if os.path.commonpath((path, self._tileset_dir)) != self._tileset_dir:
+                raise RequestError(400, 'tileset must be a file in the tileset directory')
+            return ((path, os.stat(path).st_mtime_ns), path)
+        except (OSError, ValueError) as ex:
+            raise RequestError(400, 'tileset {0}: not found'.format(definition)) from ex
+    async def _load_tileset(self, definition) -> solver.TileSet:
+        """
+        Get the tileset of a request, the service's own, a definition file
+        path in the tileset directory or an inline definition
+        """
+        if definition is None:
+            return self._tileset
+        key, definition = self._tileset_key(definition)
+        loading = self._tilesets.get(key)
+        if loading is not None:
+            self._tilesets.move_to_end(key)
+        else:
+            if len(self._in_flight) >= self._queue:
+                self._stats['rejected'] += 1
+                raise RequestError(503, 'queue is full, {0} solves waiting or running'.format(len(self._in_flight)))
+            loading = self._submit(_load, definition)
+            self._tilesets[key] = loading
+            while len(self._tilesets) > TILESET_CACHE:
+                self._tilesets.popitem(last=False)
+        try:
+            return await self._wait(*loading)
+        except (RequestError, OSError, tileset.TileSetError) as ex:
+            # failures are not kept, the next request loads it again
+            if self._tilesets.get(key) is loading:
+                del self._tilesets[key]
+            if isinstance(ex, RequestError):
+                raise
+            raise RequestError(400, 'tileset: {0}'.format(ex)) from ex
+    async def _parse(self, request: dict) -> tuple:
+        """
+        Get (key, tileset, seed, options) for a request of the form
+        {"tileset", "size": "WIDTHxHEIGHT", "seed", "wrap", "constraints"}
+        """
+        if not isinstance(request, dict):
+            raise RequestError(400, 'request must be a json object')
+        tiles = await self._load_tileset(request.get('tileset'))
+        try:
+            width, height = batch.parse_size(str(request['size'])) if 'size' in request else self._size
+            if width > self._max_size[0] or height > self._max_size[1]:
+                raise ValueError('size must be at most {0}x{1}, got {2}x{3}'.format(
+                    self._max_size[0], self._max_size[1], width, height))
+            seed = request.get('seed')
+            if seed is None:
+                seed = random.randrange(sys.maxsize)
+            if isinstance(seed, bool) or not isinstance(seed, int):
+                raise ValueError('seed must be a number, got {0}'.format(seed))
+            wrap = request.get('wrap', self._wrap)
+            if not isinstance(wrap, bool):
+                raise ValueError('wrap must be true or false, got {0}'.format(wrap))
+            constraints = solver.Constraints.from_dict(tiles, request.get('constraints') or {})
+            # checked before anything expands the regions
+            constraints.check(width, height)
+        except (AttributeError, ValueError) as ex:
+            raise RequestError(400, str(ex)) from ex
+        options = dict(self._options, wrap=wrap, width=width, height=height,
+                       constraints=constraints if len(constraints) > 0 else None)
+        key = (tiles.digest(), width, height, seed, wrap, constraints.key())
+        return (key, tiles, seed, options)
+    async def generate(self, request: dict) -> tuple[bytes, str]:
+        """
+        Get the json record of the map for request and how it was found,
+        hit from the cache, coalesced with a solve in flight or a miss
+        """
+        key, tiles, seed, options = await self._parse(request)
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self._stats['hits'] += 1
+            return (record, 'hit')
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._stats['coalesced'] += 1
+            return (await self._wait(*in_flight), 'coalesced')
+        if len(self._in_flight) >= self._queue:
+            self._stats['rejected'] += 1
+            raise RequestError(503, 'queue is full, {0} solves waiting or running'.format(len(self._in_flight)))
+        self._stats['misses'] += 1
+        start = time.perf_counter()
+        future, executor = self._submit(_solve, (tiles, seed, options))
+        self._in_flight[key] = (future, executor)
+        try:
+            record = await self._wait(future, executor)
+        finally:
+            del self._in_flight[key]
+        self._solve_times.append(time.perf_counter() - start)
+        if self._cache_size > 0:
+            self._cache[key] = record
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return (record, 'miss')
+    def _pool(self) -> ProcessPoolExecutor:
+        """Get the worker pool, starting it if needed."""
+        if self._executor is None:
+            # spawned so workers do not inherit open client connections, which would stay open
+            self._executor = ProcessPoolExecutor(max_workers=self._jobs,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+    def _submit(self, function, argument) -> tuple[asyncio.Future, ProcessPoolExecutor]:
+        """Run function(argument) in the worker pool, get (future, pool)."""
+        loop = asyncio.get_running_loop()
+        executor = self._pool()
+        try:
+            return (loop.run_in_executor(executor, function, argument), executor)
+        except BrokenProcessPool:
+            self._drop_pool(executor)
+            executor = self._pool()
+            return (loop.run_in_executor(executor, function, argument), executor)
+    def _drop_pool(self, executor: ProcessPoolExecutor) -> None:
+        """Stop a pool whose worker died so the next solve starts a new one."""
+        if self._executor is executor:
+            logging.warning('worker process died, starting a new pool')
+            self._stats['broken_pools'] += 1
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+    async def _wait(self, future: asyncio.Future, executor: ProcessPoolExecutor) -> bytes:
+        """Wait for a solve, shielded so a client hanging up does not cancel it for the others."""
+        try:
+            return await asyncio.shield(future)
+        except BrokenProcessPool as ex:
+            # every solve in flight on the pool fails, later ones go to a new pool
+            self._drop_pool(executor)
+            raise RequestError(503, 'worker process died during the solve') from ex
+        except solver.UnsatisfiableError as ex:
+            raise RequestError(422, str(ex), cells=ex.cells) from ex
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Answer one http request, POST /generate with a json request,
+        GET /stats for the counters, then close the connection
+        """
+        start = time.perf_counter()
+        headers = {}
+        try:
+            method, path, body = await self._read(reader)
+            self._stats['requests'] += 1
+            if path == '/generate':
+                if method != 'POST':
+                    raise RequestError(405, 'use POST for /generate')
+                try:
+                    request = json.loads(body) if body else {}
+                except ValueError as ex:
+                    raise RequestError(400, 'request is not valid json: {0}'.format(ex)) from ex
+                payload, cache = await self.generate(request)
+                headers['X-Cache'] = cache
+                self._latencies.append(time.perf_counter() - start)
+            elif path == '/stats':
+                if method != 'GET':
+                    raise RequestError(405, 'use GET for /stats')
+                payload = json.dumps(self.stats()).encode('utf-8')
+            else:
+                raise RequestError(404, 'unknown path {0}'.format(path))
+            status = 200
+        except RequestError as ex:
+            self._stats['errors'] += 1
+            status = ex.status
+            payload = json.dumps(dict(ex.details, error=str(ex))).encode('utf-8')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as ex: # pylint: disable=broad-exception-caught
+            # a solver bug, the service keeps serving
+            logging.exception('request failed')
+            self._stats['errors'] += 1
+            status = 500
+            payload = json.dumps({'error': str(ex)}).encode('utf-8')
+        lines = ['HTTP/1.1 {0} {1}'.format(status, REASONS[status]),
+                 'Content-Type: application/json',
+                 'Content-Length: {0}'.format(len(payload)),
+                 'Connection: close']
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+        try:
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    async def _read(self, reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+        """Read (method, path, body) of an http request."""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            method, path = request_line[0], request_line[1].split('?')[0]
+            length = 0
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+        except (IndexError, ValueError) as ex:
+            raise RequestError(400, 'malformed http request') from ex
+        if length > MAX_BODY:
+            raise RequestError(413, 'request is over {0} bytes'.format(MAX_BODY))
+        return (method, path, await reader.readexactly(length) if length > 0 else b'')
+
+async def _serve(service: Service, host: str, port: int, socket_path: str) -> None:
+    """Serve until cancelled."""
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(service.handle, socket_path)
+    else:
+        server = await asyncio.start_server(service.handle, host, port)
+    logging.info('serving on %s', socket_path or '{0}:{1}'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+def serve(service: Service, host: str = '127.0.0.1', port: int = 8080, socket_path: str = None) -> None:
+    """Serve http requests on host and port, or on a unix socket at socket_path, until interrupted."""
+    try:
+        asyncio.run(_serve(service, host, port, socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -1,246 +1,1248 @@
 """Solver"""
 
+import array
+import hashlib
+import heapq
 import logging
+import math
+import mmap
 import os
+import struct
+from collections import deque
+from collections.abc import Iterator
 import random
 import sys
-import time
-import pygame
+from instrument import Instrument
 
-COLOUR_WHITE = (255,255,255)
-COLOUR_RED = (255,0,0)
-COLOUR_GREEN = (0,255,0)
-COLOUR_YELLOW = (255,255,0)
-COLOUR_ORANGE = (255,80,0)
-
-TILE_WIDTH = 32
-TILE_HEIGHT = 32
 TILE_X = 20
 TILE_Y = 20
 
+DIRECTIONS = ('n', 'e', 's', 'w')
+
+OPPOSITE_DIRECTION = {
+    'n': 's',
+    'e': 'w',
+    's': 'n',
+    'w': 'e'
+}
+
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), 'tiles')
+
 class TileSet():
-    """Represents a tileset."""
-    def __init__(self, tiles: dict) -> None:
-        self._tiles = tiles
-        image_path = os.path.dirname(__file__)
+    """
+    Represents a tileset.
+    Rules are compiled once into per direction bitmasks so a set of
+    choices can be held as an int with one bit per tile index
+    Images are loaded from image_dir the first time they are asked for
+    so solving without a display never needs pygame
+    """
+    def __init__(self, tiles: dict, image_dir: str = IMAGE_DIR) -> None:
+        names = list(tiles.keys())
+        index = {name: i for i, name in enumerate(names)}
+        masks = {}
+        for direction in DIRECTIONS:
+            masks[direction] = []
+            for name in names:
+                mask = 0
+                for allowed in tiles[name]['rules'][direction]:
+                    mask |= 1 << index[allowed]
+                masks[direction].append(mask)
+        self._setup(names, [tiles[name]['weight'] for name in names], masks, image_dir)
+    @classmethod
+    def from_masks(cls, names: list[str], weights: list[float], masks: dict,
+                   image_dir: str = IMAGE_DIR) -> 'TileSet':
+        """Get tileset from masks of tiles allowed in each direction by each tile index."""
+        tileset = cls.__new__(cls)
+        tileset._setup(names, weights, masks, image_dir)
+        return tileset
+    def _setup(self, names: list[str], weights: list[float], masks: dict, image_dir: str) -> None:
+        self._names = list(names)
+        self._weights = dict(zip(self._names, weights))
+        self._index = {name: i for i, name in enumerate(self._names)}
+        self._full = (1 << len(self._names)) - 1
+        self._image_dir = image_dir
         self._images = {}
-        for name in self._tiles.keys():
-            self._images[name] = pygame.image.load(os.path.join(image_path, 'tiles', '{0}.png'.format(name)))
+        # mask of tiles allowed in direction for each tile index
+        self._masks = {direction: list(masks[direction]) for direction in DIRECTIONS}
+        # mask of tiles whose rule in direction allows each tile index
+        self._supporters = {}
+        for direction, direction_masks in self._masks.items():
+            supporters = [0] * len(self._names)
+            for i, mask in enumerate(direction_masks):
+                for j in indices(mask):
+                    supporters[j] |= 1 << i
+            self._supporters[direction] = supporters
+        # union of masks for a set of choices, filled in as sets are seen
+        self._allowed = {direction: {} for direction in self._masks}
+    def __getstate__(self) -> dict:
+        # images are not picklable, workers load their own if they need them
+        state = self.__dict__.copy()
+        state['_images'] = {}
+        return state
     def names(self) -> list[str]:
         """Get tile names."""
-        return list(self._tiles.keys())
-    def rule(self, tile_name: str, direction: str) -> dict:
-        """Get rules for tile and direction."""
-        return self._tiles[tile_name]['rules'][direction]
-    def weight(self, tile_name: str) -> int:
+        return self._names
+    def rule(self, tile_name: str, direction: str) -> list[str]:
+        """Get names of tiles allowed in direction by tile."""
+        return self.decode(self._masks[direction][self._index[tile_name]])
+    def weight(self, tile_name: str) -> float:
         """Get weight for tile."""
-        return self._tiles[tile_name]['weight']
-    def image(self, tile_name: str) -> pygame.Surface:
-        """Get image for tile."""
-        return self._images[tile_name]
+        return self._weights[tile_name]
+    def image(self, tile_name: str) -> 'pygame.Surface':
+        """Get image for tile, loading it on first use."""
+        image = self._images.get(tile_name)
+        if image is None:
+            import pygame # pylint: disable=import-outside-toplevel
+            image = pygame.image.load(os.path.join(self._image_dir, '{0}.png'.format(tile_name)))
+            self._images[tile_name] = image
+        return image
+    def full(self) -> int:
+        """Get mask with every tile set."""
+        return self._full
+    def index(self, tile_name: str) -> int:
+        """Get index for tile."""
+        return self._index[tile_name]
+    def mask(self, tile_index: int, direction: str) -> int:
+        """Get mask of tiles allowed in direction by tile index."""
+        return self._masks[direction][tile_index]
+    def supporters(self, tile_index: int, direction: str) -> int:
+        """Get mask of tiles that allow tile index in direction."""
+        return self._supporters[direction][tile_index]
+    def encode(self, tile_names: list[str]) -> int:
+        """Get mask for list of tile names."""
+        mask = 0
+        for name in tile_names:
+            mask |= 1 << self._index[name]
+        return mask
+    def decode(self, mask: int) -> list[str]:
+        """Get list of tile names in mask, in tileset order."""
+        return [self._names[i] for i in indices(mask)]
+    def allowed(self, mask: int, direction: str) -> int:
+        """
+        Get mask of all tiles allowed in direction (n,e,s,w)
+        by any of the tiles in mask
+        """
+        cache = self._allowed[direction]
+        allowed = cache.get(mask)
+        if allowed is None:
+            masks = self._masks[direction]
+            allowed = 0
+            for i in indices(mask):
+                allowed |= masks[i]
+            cache[mask] = allowed
+        return allowed
+    def digest(self) -> bytes:
+        """Get a hash of the tile names, weights and rules."""
+        digest = hashlib.sha256()
+        for i, name in enumerate(self._names):
+            encoded = name.encode('utf-8')
+            # weights as doubles so int weights from json and float weights
+            # from a compiled tileset hash the same
+            digest.update(struct.pack('<H', len(encoded)) + encoded + struct.pack('<d', float(self._weights[name])))
+            for direction in DIRECTIONS:
+                digest.update(self._masks[direction][i].to_bytes((len(self._names) + 7) // 8, 'little'))
+        return digest.digest()[:16]
+
+def indices(mask: int) -> list[int]:
+    """Get indices of set bits in mask, lowest first."""
+    result = []
+    while mask:
+        low = mask & -mask
+        result.append(low.bit_length() - 1)
+        mask ^= low
+    return result
 
 class Cell():
-    """Represents a cell in the grid."""
-    def __init__(self, r: int, c: int, choices: list[str]) -> None:
-        self._r = r
-        self._c = c
-        self._choices = choices
+    """
+    Represents a cell in the grid.
+    A view of one entry in the solver's flat array of choices
+    """
+    __slots__ = ('_solver', '_index')
+    def __init__(self, solver: 'Solver', index: int) -> None:
+        self._solver = solver
+        self._index = index
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Cell) and other.solver is self._solver and other.index == self._index
+    def __hash__(self) -> int:
+        return hash(self._index)
     @property
     def choices(self) -> list[str]:
         """Get choices list."""
-        return self._choices
+        return self._solver.tileset.decode(self.domain)
     @choices.setter
     def choices(self, choices: list[str]):
         """Set choices list."""
-        self._choices = choices
+        self.domain = self._solver.tileset.encode(choices)
+    @property
+    def domain(self) -> int:
+        """Get choices as a tile mask."""
+        return self._solver.domain(self._index)
+    @domain.setter
+    def domain(self, domain: int):
+        """Set choices as a tile mask."""
+        self._solver.set_domain(self._index, domain)
+    @property
+    def solver(self) -> 'Solver':
+        """Get solver."""
+        return self._solver
+    @property
+    def index(self) -> int:
+        """Get index in the solver's flat grid."""
+        return self._index
     @property
     def row(self) -> int:
         """Get row."""
-        return self._r
+        return self._index // self._solver.width
     @property
     def col(self) -> int:
         """Get col."""
-        return self._c
+        return self._index % self._solver.width
+
+def domain_array(size: int, tile_count: int, domain: int):
+    """
+    Get a flat array of size copies of domain, one int per cell
+    packed in the smallest item that holds tile_count bits
+    """
+    for typecode in ('B', 'H', 'I', 'L', 'Q'):
+        if array.array(typecode).itemsize * 8 >= tile_count:
+            return array.array(typecode, [domain]) * size
+    # too many tiles for a machine int
+    return [domain] * size
+
+# ac3 re-checks every neighbour of a changed cell against its whole domain,
+# ac4 keeps support counters so only removed tiles are followed
+PROPAGATION = ('ac3', 'ac4')
+
+# count picks the cell with the fewest choices, shannon weighs the
+# choices by tile weight
+ENTROPY = ('count', 'shannon')
+
+def derive_seed(seed: int, *parts: int) -> int:
+    """Derive a new seed from a seed and one or more integers."""
+    return random.Random(':'.join(str(part) for part in (seed,) + parts)).randrange(sys.maxsize)
+
+class Recovery():
+    """
+    What the solver does when a cell is left with no choices
+    levels is the number of decisions to undo on each backtrack (0 to not backtrack),
+    max_backtracks the backtracks allowed before restarting (None for no limit)
+    and restarts the number of times to start again with a derived seed
+    before giving up, with no levels and no restarts the solver keeps going
+    """
+    def __init__(self, levels: int = 0, max_backtracks: int = None, restarts: int = 0) -> None:
+        if levels < 0 or restarts < 0 or (max_backtracks is not None and max_backtracks < 0):
+            raise ValueError('recovery limits must not be negative')
+        self._levels = levels
+        self._max_backtracks = max_backtracks
+        self._restarts = restarts
+    @property
+    def levels(self) -> int:
+        """Get decisions to undo on each backtrack."""
+        return self._levels
+    @property
+    def max_backtracks(self) -> int:
+        """Get backtracks allowed before restarting."""
+        return self._max_backtracks
+    @property
+    def restarts(self) -> int:
+        """Get restarts allowed before giving up."""
+        return self._restarts
+    def enabled(self) -> bool:
+        """Check if the solver should stop at a contradiction."""
+        return self._levels > 0 or self._restarts > 0
+
+class UnsatisfiableError(ValueError):
+    """Constraints leave cells with no choices."""
+    def __init__(self, message: str, cells: list[tuple[int, int]]) -> None:
+        super().__init__(message)
+        self.cells = cells
+    def __reduce__(self):
+        return (self.__class__, (str(self), self.cells))
+
+def _are_ints(*values) -> bool:
+    """Check that values are all ints and not bools."""
+    return all(isinstance(value, int) and not isinstance(value, bool) for value in values)
+
+class Constraints():
+    """
+    Tiles pinned to cells and regions limited to sets of tiles,
+    applied together by Solver.constrain, a cell given more than
+    one constraint keeps only the tiles allowed by all of them
+    Regions are kept as rectangles until masks expands them
+    """
+    def __init__(self, tileset: TileSet) -> None:
+        self._tileset = tileset
+        # mask of allowed tiles keyed by (row, col)
+        self._masks = {}
+        # (row, col, width, height, mask) for each region
+        self._regions = []
+    @classmethod
+    def from_dict(cls, tileset: TileSet, data: dict) -> 'Constraints':
+        """
+        Get constraints from {"pins": [{"row", "col", "tile"}],
+        "regions": [{"row", "col", "width", "height", "tiles"}]}
+        """
+        constraints = cls(tileset)
+        try:
+            for pin in data.get('pins', []):
+                constraints.pin(pin['row'], pin['col'], pin['tile'])
+            for region in data.get('regions', []):
+                constraints.region(region['row'], region['col'], region['width'], region['height'],
+                                   region['tiles'])
+        except (AttributeError, KeyError, TypeError) as ex:
+            raise ValueError('constraints must have pins with row, col and tile and regions '
+                             'with row, col, width, height and tiles') from ex
+        return constraints
+    def __len__(self) -> int:
+        return len(self._masks) + len(self._regions)
+    def pin(self, row: int, col: int, tile_name: str) -> None:
+        """Allow only tile at (row, col)."""
+        self.limit(row, col, self._encode([tile_name]))
+    def region(self, row: int, col: int, width: int, height: int, tile_names: list[str]) -> None:
+        """Allow only the tiles in tile_names in a width by height region from (row, col)."""
+        if not _are_ints(row, col, width, height):
+            raise ValueError('region row, col, width and height must be whole numbers')
+        if width < 1 or height < 1:
+            raise ValueError('region at ({0}, {1}) must be at least 1x1'.format(row, col))
+        self._regions.append((row, col, width, height, self._encode(tile_names)))
+    def limit(self, row: int, col: int, mask: int) -> None:
+        """Allow only the tiles in mask at (row, col)."""
+        if not _are_ints(row, col, mask):
+            raise ValueError('constraint row, col and mask must be whole numbers')
+        self._masks[(row, col)] = self._masks.get((row, col), self._tileset.full()) & mask
+    def remove(self, row: int, col: int) -> None:
+        """Allow every tile at (row, col) again."""
+        self._masks.pop((row, col), None)
+    def check(self, width: int, height: int) -> None:
+        """Raise ValueError if a constraint is outside a width by height grid."""
+        for row, col in self._masks:
+            if not (0 <= row < height and 0 <= col < width):
+                raise ValueError('constraint at ({0}, {1}) is outside the grid'.format(row, col))
+        for row, col, region_width, region_height, _ in self._regions:
+            if not (0 <= row and 0 <= col and row + region_height <= height and col + region_width <= width):
+                raise ValueError('region {0}x{1} at ({2}, {3}) is outside the grid'.format(
+                    region_width, region_height, row, col))
+    def key(self) -> tuple:
+        """Get the constraints in a hashable form."""
+        return (tuple(sorted(self._masks.items())), tuple(self._regions))
+    def masks(self) -> dict[tuple[int, int], int]:
+        """Get mask of allowed tiles keyed by (row, col), with regions expanded to their cells."""
+        masks = dict(self._masks)
+        full = self._tileset.full()
+        for row, col, width, height, mask in self._regions:
+            for region_row in range(row, row + height):
+                for region_col in range(col, col + width):
+                    masks[(region_row, region_col)] = masks.get((region_row, region_col), full) & mask
+        return masks
+    def _encode(self, tile_names: list[str]) -> int:
+        """Get mask for tile names, raises ValueError for a name not in the tileset."""
+        if isinstance(tile_names, str) or not all(isinstance(name, str) for name in tile_names):
+            raise ValueError('tiles must be a list of tile names')
+        unknown = [name for name in tile_names if name not in self._tileset.names()]
+        if len(unknown) > 0:
+            raise ValueError('unknown tiles {0}'.format(', '.join(unknown)))
+        return self._tileset.encode(tile_names)
+
+class Event():
+    """
+    A cell collapsed by one solver step, index of the cell, the tile
+    chosen and the indices of the other cells whose choices changed
+    in the same step (by propagation or recovery), these include the
+    collapsed cell itself if recovery undid the collapse
+    """
+    __slots__ = ('_index', '_tile', '_narrowed')
+    def __init__(self, index: int, tile: int, narrowed: tuple) -> None:
+        self._index = index
+        self._tile = tile
+        self._narrowed = narrowed
+    def __repr__(self) -> str:
+        return 'Event({0}, {1}, {2})'.format(self._index, self._tile, self._narrowed)
+    @property
+    def index(self) -> int:
+        """Get index of the collapsed cell."""
+        return self._index
+    @property
+    def tile(self) -> int:
+        """Get index of the chosen tile."""
+        return self._tile
+    @property
+    def narrowed(self) -> tuple[int, ...]:
+        """Get indices of the cells changed in the step after the collapse."""
+        return self._narrowed
+
+# checkpoint file layout, a fixed header then the random state, the domain
+# array and the entropy index, weight sums, trail, decision and constraint records
+CHECKPOINT_MAGIC = b'WFCS'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_HEADER = struct.Struct('<4sHHIIHBxqQQQIQqIqI16sQQQQQQQ')
+CHECKPOINT_RANDOM = struct.Struct('<625IBd')
+CHECKPOINT_HEAP = struct.Struct('<ddI')
+CHECKPOINT_SUMS = struct.Struct('<Idd')
+CHECKPOINT_TRAIL = struct.Struct('<IQ')
+CHECKPOINT_DECISION = struct.Struct('<QIH')
+CHECKPOINT_CONSTRAINT = struct.Struct('<IQ')
+
+CHECKPOINT_WRAP = 1
+CHECKPOINT_AC4 = 2
+CHECKPOINT_SHANNON = 4
+CHECKPOINT_TRAIL_KEPT = 8
+CHECKPOINT_GAVE_UP = 16
 
 class Solver():
-    """Solver"""
-    def __init__(self, tileset: TileSet, seed: int, wrap=False):
+    """
+    Solver
+    The choices for every cell are held in one flat array, row by row,
+    with one tile mask per cell
+    """
+    def __init__(self, tileset: TileSet, seed: int, wrap=False, propagation='ac3', entropy='count',
+                 recovery: Recovery = None, width: int = TILE_X, height: int = TILE_Y,
+                 instrument: Instrument = None, constraints: Constraints = None):
+        if propagation not in PROPAGATION:
+            raise ValueError('unknown propagation {0}'.format(propagation))
+        if entropy not in ENTROPY:
+            raise ValueError('unknown entropy {0}'.format(entropy))
+        if width < 1 or height < 1:
+            raise ValueError('grid must be at least 1x1')
         self._tileset = tileset
+        self._width = width
+        self._height = height
+        self._size = width * height
         self._wrap = wrap
+        self._propagation = propagation
+        self._entropy = entropy
+        self._recovery = recovery if recovery is not None else Recovery()
         self._seed = seed
         if self._seed is None:
             self._seed = random.randrange(sys.maxsize)
-        self._random = random.Random(self._seed)
 
         logging.info('seed is %i', self._seed)
 
-        self._grid = []
-        for row in range(0, TILE_Y):
-            self._grid.append([])
-            for col in range(0, TILE_X):
-                self._grid[row].append([Cell])
-                self._grid[row][col] = Cell(row, col, self._tileset.names())
+        self._full = self._tileset.full()
+        self._weights = [self._tileset.weight(name) for name in self._tileset.names()]
+        self._weight_logs = [weight * math.log(weight) for weight in self._weights]
+        self._full_weight_sums = (sum(self._weights), sum(self._weight_logs))
+        self._full_entropy = self._entropy_of(self._full, self._full_weight_sums)
         self._get_cell_dict = {
             'n': self.get_north,
             'e': self.get_east,
             's': self.get_south,
             'w': self.get_west
         }
-        self._opposite_direction = {
-            'n': 's',
-            'e': 'w',
-            's': 'n',
-            'w': 'e'
-        }
+        self._full_supports = {}
+        for direction in DIRECTIONS:
+            self._full_supports[direction] = [self._tileset.supporters(i, direction).bit_count()
+                                              for i in range(len(self._tileset.names()))]
         self._firstchanged = None
-        self._checked = []
-        self._changed = []
+        self._chosen_tile = None
+        # indices of cells changed in the current step while events are taken
+        self._changes = None
+        # hook for counters, timers and tracing, None to skip them
+        self._instrument = instrument
+        self._contradictions = 0
+        self._backtracks = 0
+        self._restarts = 0
+        self._gave_up = False
+        self._steps = 0
+        # indices of cells changed since take_dirty, None when not tracked
+        self._dirty = None
+        # mask of allowed tiles keyed by index, applied again on restart
+        self._constraints = {}
+        self._reset(self._seed)
+        if constraints is not None:
+            self.constrain(constraints)
+    def _reset(self, seed: int) -> None:
+        """Start again with every cell able to take every tile."""
+        self._random = random.Random(seed)
+        self._domains = domain_array(self._size, len(self._tileset.names()), self._full)
+        # (sum of weights, sum of weight * log weight) for cells that have narrowed
+        self._weight_sums = {}
+        # min entropy index of cells that have narrowed, entries are
+        # (entropy, noise, index, domain), entries whose domain no longer
+        # matches the cell are skipped, cells with every choice are
+        # counted rather than indexed
+        self._entropy_heap = []
+        self._full_cells = self._size
+        self._undecided = self._size if self._full.bit_count() > 1 else 0
+        # ac4 support counters keyed by (index, direction), created when first needed
+        self._supports = {}
+        # index of first cell left with no choices since the last recovery
+        self._contradiction = None
+        # (index, old domain) for every change since the first decision,
+        # and (trail length, index, tile) for every decision
+        self._trail = [] if self._recovery.levels > 0 else None
+        self._decisions = []
+        self._attempt_backtracks = 0
+        if self._dirty is not None:
+            self._dirty = set(range(self._size))
+        if self._changes is not None:
+            self._changes.extend(range(self._size))
+        if self._constraints:
+            self._apply_constraints(self._constraints)
     @property
     def seed(self):
         """Get the seed."""
         return self._seed
+    @property
+    def tileset(self) -> TileSet:
+        """Get the tileset."""
+        return self._tileset
+    @property
+    def width(self) -> int:
+        """Get number of columns."""
+        return self._width
+    @property
+    def height(self) -> int:
+        """Get number of rows."""
+        return self._height
+    @property
+    def contradictions(self) -> int:
+        """Get number of cells left with no choices."""
+        return self._contradictions
+    @property
+    def backtracks(self) -> int:
+        """Get number of backtracks."""
+        return self._backtracks
+    @property
+    def restarts(self) -> int:
+        """Get number of restarts."""
+        return self._restarts
+    @property
+    def gave_up(self) -> bool:
+        """Check if the solver ran out of recovery budget."""
+        return self._gave_up
+    @property
+    def steps(self) -> int:
+        """Get number of steps taken."""
+        return self._steps
+    @property
+    def instrument(self) -> Instrument:
+        """Get instrument or None."""
+        return self._instrument
     def get_cell(self, row: int, col: int) -> Cell:
         """Get cell at (row, col)"""
-        return self._grid[row][col]
-    def get_image(self, tile_name: str) -> pygame.Surface:
-        """Get tileset image"""
-        return self._tileset.image(tile_name)
+        return Cell(self, row * self._width + col)
+    def domain(self, index: int) -> int:
+        """Get choices as a tile mask for cell at index"""
+        return self._domains[index]
+    def set_domain(self, index: int, domain: int) -> None:
+        """
+        Set choices as a tile mask for cell at index, keeping the undo
+        trail, undecided count, weight sums and entropy index up to date
+        """
+        old = self._domains[index]
+        if old == domain:
+            return
+        self._domains[index] = domain
+        if self._trail is not None:
+            self._trail.append((index, old))
+        if self._dirty is not None:
+            self._dirty.add(index)
+        if self._changes is not None:
+            self._changes.append(index)
+        if domain == 0:
+            self._contradictions += 1
+            if self._contradiction is None:
+                self._contradiction = index
+        if old == self._full:
+            self._full_cells -= 1
+        elif domain == self._full:
+            self._full_cells += 1
+        was_undecided = old & (old - 1) != 0
+        is_undecided = domain & (domain - 1) != 0
+        if was_undecided and not is_undecided:
+            self._undecided -= 1
+            if self._supports:
+                # a decided cell is checked directly, its counters are rebuilt on undo
+                for direction in DIRECTIONS:
+                    self._supports.pop((index, direction), None)
+        elif is_undecided and not was_undecided:
+            self._undecided += 1
+        if self._entropy == 'shannon':
+            if is_undecided:
+                sums = self._weight_sums.get(index)
+                if sums is None:
+                    sums = self._weight_sums_of(old)
+                sum_weights, sum_weight_logs = sums
+                for i in indices(old & ~domain):
+                    sum_weights -= self._weights[i]
+                    sum_weight_logs -= self._weight_logs[i]
+                for i in indices(domain & ~old):
+                    sum_weights += self._weights[i]
+                    sum_weight_logs += self._weight_logs[i]
+                self._weight_sums[index] = (sum_weights, sum_weight_logs)
+            else:
+                self._weight_sums.pop(index, None)
+        if is_undecided and domain != self._full:
+            heapq.heappush(self._entropy_heap, (self.entropy(index), self._random.random(), index, domain))
+            if len(self._entropy_heap) > 4 * max(1024, self._undecided - self._full_cells):
+                self._compact_index()
+    def _compact_index(self) -> None:
+        """Drop entries from the entropy index that no longer match their cell."""
+        entries = {}
+        for entry in self._entropy_heap:
+            if self._domains[entry[2]] == entry[3]:
+                entries[entry[2]] = entry
+        self._entropy_heap = list(entries.values())
+        heapq.heapify(self._entropy_heap)
+    def track_dirty(self) -> None:
+        """Start recording the indices of changed cells for take_dirty."""
+        if self._dirty is None:
+            self._dirty = set()
+    def take_dirty(self) -> set[int]:
+        """Get the indices of cells changed since the last call."""
+        dirty = self._dirty
+        self._dirty = set()
+        return dirty
     def checked_cells(self) -> list[Cell]:
-        """Get list of checked cells"""
-        return self._checked
+        """Get list of cells checked in the last step, empty unless the instrument traces"""
+        if self._instrument is None:
+            return []
+        return [Cell(self, index) for index in self._instrument.checked]
     def changed_cells(self) -> list[Cell]:
-        """Get list of changed cells"""
-        return self._changed
+        """Get list of cells changed in the last step, empty unless the instrument traces"""
+        if self._instrument is None:
+            return []
+        return [Cell(self, index) for index in self._instrument.changed]
     def resolved_cell(self) -> Cell:
         """Get list of resolved cells"""
-        return self._firstchanged
+        if self._firstchanged is None:
+            return None
+        return Cell(self, self._firstchanged)
     def solve(self) -> bool:
         """
-        For all cells with greater than one choice
-        Get all the cells with the lowest number of choices
-        Pick a random cell
+        Take the cell with the lowest entropy from the index
+        (ties broken at random)
         Choose once of the tiles available to the cell
         """
-        logging.info('solve')
         self._firstchanged = None
-        self._checked.clear()
-        self._changed.clear()
-        # get all cells with more than one choice
-        data = [cell for row in self._grid for cell in row if len(cell.choices) > 1]
-        # sort by number of choices
-        data.sort(key=lambda cell: len(cell.choices), reverse=False)
-        logging.info('num cells %i', len(data))
-        if len(data) > 0:
-            # find min choices
-            num_choices = len(data[0].choices)
-            logging.info('min choices %i', num_choices)
-            # filter for cells with same number of choices
-            data = [d for d in data if len(d.choices) == num_choices]
-            logging.info('num cells %i', len(data))
-            # pick random cell with least choices
-            cell = self._random.choice(data)
+        if self._gave_up:
+            return True
+        self._steps += 1
+        instrument = self._instrument
+        if instrument is not None:
+            instrument.start_step()
+        # pick random cell with least entropy
+        index = self.observe()
+        if index != -1:
             # select one of the options
-            weights = list(map(self._tileset.weight, cell.choices))
-            chosen_tile = self._random.choices(cell.choices, weights=weights, k=1)[0]
+            domain = self._domains[index]
+            choices = indices(domain)
+            weights = [self._weights[i] for i in choices]
+            chosen_tile = self._random.choices(choices, weights=weights, k=1)[0]
+            if self._trail is not None:
+                self._decisions.append((len(self._trail), index, chosen_tile))
             # should we check before choosing that it's still valid
-            cell.choices = [chosen_tile]
+            self.set_domain(index, 1 << chosen_tile)
             # flag as first changed
-            self._firstchanged = cell
+            self._firstchanged = index
+            self._chosen_tile = chosen_tile
             # resolve neighbourhood
-            self.resolve_cell_neighbours(cell)
-        return self.is_complete()
-    def is_complete(self):
+            if instrument is not None:
+                instrument.switch('propagate')
+            self.propagate([(index, domain & ~(1 << chosen_tile))])
+            if self._contradiction is not None and self._recovery.enabled():
+                if instrument is not None:
+                    instrument.switch('recover')
+                self.recover()
+        if instrument is not None:
+            instrument.end_step(index != -1)
+        if self.is_complete():
+            logging.info('complete after %i backtracks and %i restarts', self._backtracks, self._restarts)
+            return True
+        return self._gave_up
+    def recover(self) -> None:
+        """
+        Backtrack, restart or give up until the grid
+        no longer has a cell with no choices
+        """
+        while self._contradiction is not None:
+            if (self._recovery.levels > 0 and len(self._decisions) > 0 and
+                    (self._recovery.max_backtracks is None or
+                     self._attempt_backtracks < self._recovery.max_backtracks)):
+                self.backtrack(self._recovery.levels)
+            elif self._restarts < self._recovery.restarts:
+                self._restarts += 1
+                logging.info('restart %i', self._restarts)
+                self._reset(derive_seed(self._seed, self._restarts))
+            else:
+                logging.warning('gave up after %i backtracks and %i restarts',
+                                self._backtracks, self._restarts)
+                self._gave_up = True
+                return
+    def backtrack(self, levels: int) -> None:
+        """
+        Undo the last levels decisions and rule out
+        the tile chosen by the earliest of them
+        """
+        self._backtracks += 1
+        self._attempt_backtracks += 1
+        for _ in range(min(levels, len(self._decisions))):
+            length, index, chosen_tile = self._decisions.pop()
+        logging.info('backtrack to %i decisions', len(self._decisions))
+        self.undo(length)
+        self._contradiction = None
+        self.set_domain(index, self._domains[index] & ~(1 << chosen_tile))
+        if self._domains[index] != 0:
+            self.propagate([(index, 1 << chosen_tile)])
+    def undo(self, length: int) -> None:
+        """Put back the choices of cells changed since the trail was length long."""
+        trail = self._trail
+        self._trail = None
+        restored = set()
+        while len(trail) > length:
+            index, old = trail.pop()
+            self.set_domain(index, old)
+            restored.add(index)
+        self._trail = trail
+        if self._propagation == 'ac4':
+            self._refresh_supports(restored)
+    def run(self, checkpoint: str = None, every: int = 0, trail: bool = False) -> bool:
+        """
+        Solve until every cell is complete or the solver gives up
+        With checkpoint and every the state is saved to checkpoint
+        after every that many steps, the undo trail only with trail
+        as it grows with every change and each checkpoint rewrites it
+        Returns True if the grid is complete with no contradictions
+        """
+        if checkpoint is None or every < 1:
+            while not self.solve():
+                pass
+        else:
+            while not self.solve():
+                if self._steps % every == 0:
+                    self.checkpoint(checkpoint, trail)
+        return not self._gave_up and self.contradiction_free()
+    def constrain(self, constraints: Constraints) -> None:
+        """
+        Limit cells to the tiles allowed by constraints, all of them
+        at once followed by a single propagation, the constraints are
+        kept and applied again if the solver restarts
+        Raises UnsatisfiableError if a cell is left with no choices,
+        before changing anything if a constraint allows none of a cell's
+        choices, otherwise after propagating, leaving the constraints
+        applied and the cells with no choices as contradictions
+        """
+        constraints.check(self._width, self._height)
+        masks = {row * self._width + col: mask for (row, col), mask in constraints.masks().items()}
+        empty = [index for index, mask in masks.items() if self._domains[index] & mask == 0]
+        if len(empty) > 0:
+            raise UnsatisfiableError('constraints leave {0} cells with no choices'.format(len(empty)),
+                                     [divmod(index, self._width) for index in empty])
+        for index, mask in masks.items():
+            self._constraints[index] = self._constraints.get(index, self._full) & mask
+        if not self._apply_constraints(masks):
+            empty = [index for index in range(0, self._size) if self._domains[index] == 0]
+            raise UnsatisfiableError('propagating constraints leaves {0} cells with no choices'.format(len(empty)),
+                                     [divmod(index, self._width) for index in empty])
+    def _apply_constraints(self, masks: dict[int, int]) -> bool:
+        """
+        Take the tiles not in masks from the cells they are keyed by
+        and propagate the changes together
+        Returns False if a cell is left with no choices
+        """
+        changes = []
+        for index, mask in masks.items():
+            domain = self._domains[index]
+            if domain & mask != domain:
+                self.set_domain(index, domain & mask)
+                changes.append((index, domain & ~mask))
+        self.propagate(changes)
+        return self._contradiction is None
+    def events(self, batch: int = None) -> Iterator:
+        """
+        Solve one step each time an event is taken, yielding an Event
+        for every collapse until every cell is complete or the solver
+        gives up, with batch events are yielded in lists of up to batch
+        """
+        if batch is not None and batch < 1:
+            raise ValueError('batch must be at least 1')
+        changes = []
+        pending = []
+        self._changes = changes
+        try:
+            done = False
+            while not done:
+                changes.clear()
+                done = self.solve()
+                index = self._firstchanged
+                if index is None:
+                    continue
+                # a backtrack or restart may have undone the collapse itself
+                undone = self._domains[index] != 1 << self._chosen_tile
+                event = Event(index, self._chosen_tile,
+                              tuple(changed for changed in dict.fromkeys(changes) if changed != index or undone))
+                if batch is None:
+                    yield event
+                else:
+                    pending.append(event)
+                    if len(pending) == batch:
+                        yield pending
+                        pending = []
+            if len(pending) > 0:
+                yield pending
+        finally:
+            self._changes = None
+    def checkpoint(self, path: str, trail: bool = True) -> None:
+        """
+        Save the solver state to path, written aside and renamed so a
+        crash never leaves half a file, without trail the undo trail
+        is left out and a resumed solver cannot backtrack past this point
+        """
+        if not isinstance(self._domains, array.array):
+            raise ValueError('checkpoints hold at most 64 tiles')
+        # the index is saved as it is, after dropping stale entries
+        self._compact_index()
+        keep_trail = trail and self._trail is not None
+        flags = ((CHECKPOINT_WRAP if self._wrap else 0) |
+                 (CHECKPOINT_AC4 if self._propagation == 'ac4' else 0) |
+                 (CHECKPOINT_SHANNON if self._entropy == 'shannon' else 0) |
+                 (CHECKPOINT_TRAIL_KEPT if keep_trail else 0) |
+                 (CHECKPOINT_GAVE_UP if self._gave_up else 0))
+        recovery = self._recovery
+        trail_entries = self._trail if keep_trail else []
+        decisions = self._decisions if keep_trail else []
+        header = CHECKPOINT_HEADER.pack(
+            CHECKPOINT_MAGIC, CHECKPOINT_VERSION, flags, self._width, self._height,
+            len(self._tileset.names()), self._domains.itemsize, self._seed, self._steps,
+            self._contradictions, self._backtracks, self._restarts, self._attempt_backtracks,
+            -1 if self._contradiction is None else self._contradiction, recovery.levels,
+            -1 if recovery.max_backtracks is None else recovery.max_backtracks, recovery.restarts,
+            self._tileset.digest(), self._full_cells, self._undecided, len(self._entropy_heap),
+            len(self._weight_sums), len(trail_entries), len(decisions), len(self._constraints))
+        version, state, gauss = self._random.getstate()
+        if version != 3:
+            raise ValueError('unsupported random state version {0}'.format(version))
+        temp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as file:
+            file.write(header)
+            file.write(CHECKPOINT_RANDOM.pack(*state, gauss is not None, gauss or 0.0))
+            file.write(self._domains.tobytes())
+            file.write(b''.join(CHECKPOINT_HEAP.pack(entropy, noise, index)
+                                for entropy, noise, index, _ in self._entropy_heap))
+            file.write(b''.join(CHECKPOINT_SUMS.pack(index, *sums)
+                                for index, sums in self._weight_sums.items()))
+            file.write(b''.join(CHECKPOINT_TRAIL.pack(*entry) for entry in trail_entries))
+            file.write(b''.join(CHECKPOINT_DECISION.pack(*decision) for decision in decisions))
+            file.write(b''.join(CHECKPOINT_CONSTRAINT.pack(index, mask)
+                                for index, mask in self._constraints.items()))
+        os.replace(temp, path)
+    @classmethod
+    def resume(cls, path: str, tileset: TileSet, instrument: Instrument = None) -> 'Solver':
+        """
+        Get a solver in the state saved by Solver.checkpoint
+        The file is memory mapped and the domain array copied
+        straight from the mapping, raises ValueError if the file is
+        not a checkpoint or was saved with another tileset
+        """
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                if len(view) < CHECKPOINT_HEADER.size:
+                    raise ValueError('{0} is not a checkpoint'.format(path))
+                header = CHECKPOINT_HEADER.unpack_from(view, 0)
+                magic, version, flags, width, height, tile_count = header[:6]
+                if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+                    raise ValueError('{0} is not a version {1} checkpoint'.format(path, CHECKPOINT_VERSION))
+                if tile_count != len(tileset.names()) or header[17] != tileset.digest():
+                    raise ValueError('{0} was saved with another tileset'.format(path))
+                levels, max_backtracks, restarts = header[14:17]
+                recovery = Recovery(levels, None if max_backtracks == -1 else max_backtracks, restarts)
+                s = cls(tileset, header[7], bool(flags & CHECKPOINT_WRAP),
+                        'ac4' if flags & CHECKPOINT_AC4 else 'ac3',
+                        'shannon' if flags & CHECKPOINT_SHANNON else 'count',
+                        recovery, width, height, instrument)
+                s._restore(view, header)
+            except struct.error as ex:
+                raise ValueError('{0} is truncated'.format(path)) from ex
+            finally:
+                view.release()
+        return s
+    def _restore(self, view: memoryview, header: tuple) -> None:
+        """Take the state from a view of a checkpoint and its unpacked header."""
+        (_, _, flags, _, _, _, itemsize, _, self._steps, self._contradictions, self._backtracks,
+         self._restarts, self._attempt_backtracks, contradiction, _, _, _, _, full_cells, undecided,
+         heap_count, sums_count, trail_count, decision_count, constraint_count) = header
+        if itemsize != self._domains.itemsize:
+            raise ValueError('checkpoint has {0} byte cells, expected {1}'.format(itemsize, self._domains.itemsize))
+        self._contradiction = None if contradiction == -1 else contradiction
+        offset = CHECKPOINT_HEADER.size
+        random_state = CHECKPOINT_RANDOM.unpack_from(view, offset)
+        gauss = random_state[-1] if random_state[-2] else None
+        self._random.setstate((3, tuple(random_state[:-2]), gauss))
+        offset += CHECKPOINT_RANDOM.size
+        length = self._size * self._domains.itemsize
+        self._domains = array.array(self._domains.typecode)
+        self._domains.frombytes(view[offset:offset + length])
+        offset += length
+        domains = self._domains
+        self._entropy_heap = [(entropy, noise, index, domains[index]) for entropy, noise, index
+                              in CHECKPOINT_HEAP.iter_unpack(view[offset:offset + heap_count * CHECKPOINT_HEAP.size])]
+        offset += heap_count * CHECKPOINT_HEAP.size
+        self._weight_sums = {index: (sum_weights, sum_weight_logs) for index, sum_weights, sum_weight_logs
+                             in CHECKPOINT_SUMS.iter_unpack(view[offset:offset + sums_count * CHECKPOINT_SUMS.size])}
+        offset += sums_count * CHECKPOINT_SUMS.size
+        if flags & CHECKPOINT_TRAIL_KEPT:
+            self._trail = list(CHECKPOINT_TRAIL.iter_unpack(view[offset:offset + trail_count * CHECKPOINT_TRAIL.size]))
+            offset += trail_count * CHECKPOINT_TRAIL.size
+            self._decisions = list(CHECKPOINT_DECISION.iter_unpack(
+                view[offset:offset + decision_count * CHECKPOINT_DECISION.size]))
+            offset += decision_count * CHECKPOINT_DECISION.size
+        self._constraints = dict(CHECKPOINT_CONSTRAINT.iter_unpack(
+            view[offset:offset + constraint_count * CHECKPOINT_CONSTRAINT.size]))
+        offset += constraint_count * CHECKPOINT_CONSTRAINT.size
+        if offset != len(view):
+            raise ValueError('checkpoint is truncated or has trailing data')
+        self._full_cells = full_cells
+        self._undecided = undecided
+        self._gave_up = bool(flags & CHECKPOINT_GAVE_UP)
+        if self._propagation == 'ac4':
+            # counters are rebuilt from the cells that restrict their neighbours
+            for restricter in range(0, self._size):
+                if domains[restricter] in (0, self._full):
+                    continue
+                for direction, index in self.neighbour_indices(restricter):
+                    self._recount_supports(index, OPPOSITE_DIRECTION[direction], restricter, direction)
+    def contradiction_free(self) -> bool:
+        """Check that no cell has been left with no choices."""
+        return 0 not in self._domains
+    def tile_grid(self) -> list[list[int]]:
+        """
+        Get the chosen tile index for each cell by row,
+        -1 for a cell with no choices or that is not decided
+        """
+        grid = []
+        for row in range(0, self._height):
+            start = row * self._width
+            grid.append([domain.bit_length() - 1 if domain != 0 and domain & (domain - 1) == 0 else -1
+                         for domain in self._domains[start:start + self._width]])
+        return grid
+    def is_complete(self) -> bool:
         """Check if all cells are complete."""
-        for row in range(0, TILE_Y):
-            for col in range(0, TILE_X):
-                if len(self._grid[row][col].choices) > 1:
-                    return False
-        return True
+        return self._undecided == 0
+    def observe(self) -> int:
+        """
+        Get the index of the undecided cell with the lowest entropy
+        Returns -1 if every cell is decided
+        """
+        heap = self._entropy_heap
+        while heap:
+            _, _, index, domain = heap[0]
+            if self._domains[index] == domain:
+                break
+            heapq.heappop(heap)
+        if self._full_cells > 0 and self._undecided > 0:
+            if len(heap) == 0 or self._full_entropy < heap[0][0]:
+                return self._random_full_cell()
+        if heap:
+            return heapq.heappop(heap)[2]
+        return -1
+    def _random_full_cell(self) -> int:
+        """Get the index of a random cell that can still take every tile."""
+        if self._full_cells * 8 >= self._size:
+            while True:
+                index = self._random.randrange(self._size)
+                if self._domains[index] == self._full:
+                    return index
+        # few left, search from a random cell
+        start = self._random.randrange(self._size)
+        try:
+            return self._domains.index(self._full, start)
+        except ValueError:
+            return self._domains.index(self._full, 0, start)
+    def entropy(self, index: int) -> float:
+        """
+        Get entropy of cell at index, the number of choices
+        or the shannon entropy of the choices' weights
+        """
+        domain = self._domains[index]
+        if self._entropy == 'count':
+            return domain.bit_count()
+        sums = self._weight_sums.get(index)
+        if sums is None:
+            sums = self._weight_sums_of(domain)
+        return self._entropy_of(domain, sums)
+    def _entropy_of(self, domain: int, sums: tuple[float, float]) -> float:
+        """Get entropy of domain from its weight sums."""
+        if self._entropy == 'count':
+            return domain.bit_count()
+        sum_weights, sum_weight_logs = sums
+        return math.log(sum_weights) - sum_weight_logs / sum_weights
+    def _weight_sums_of(self, domain: int) -> tuple[float, float]:
+        """Get sum of weights and of weight * log weight for the tiles in domain."""
+        sum_weights = 0
+        sum_weight_logs = 0
+        for i in indices(domain):
+            sum_weights += self._weights[i]
+            sum_weight_logs += self._weight_logs[i]
+        return (sum_weights, sum_weight_logs)
     def get_cell_in_direction(self, cell: Cell, direction: str) -> Cell:
         """
         Get the cell in the specified direction (n,e,s,w)
         """
         return self._get_cell_dict[direction](cell.row, cell.col)
+    def _cell_or_false(self, index: int) -> Cell:
+        """Get cell at index, False for -1"""
+        if index == -1:
+            return False
+        return Cell(self, index)
     def get_north(self, row: int, col: int) -> Cell:
         """
         Get the cell to the north
         """
-        x_coord = col
-        if row > 0:
-            y_coord = row-1
-            return self._grid[y_coord][x_coord]
-        if self._wrap:
-            return self._grid[TILE_Y-1][x_coord]
-        return False
+        return self._cell_or_false(self.neighbour(row * self._width + col, 'n'))
     def get_south(self, row: int, col: int) -> Cell:
         """
         Get the cell to the south
         """
-        x_coord = col
-        if row < TILE_Y-1:
-            y_coord = row+1
-            return self._grid[y_coord][x_coord]
-        if self._wrap:
-            return self._grid[0][x_coord]
-        return False
+        return self._cell_or_false(self.neighbour(row * self._width + col, 's'))
     def get_west(self, row: int, col: int) -> Cell:
         """
         Get the cell to the west
         """
-        y_coord = row
-        if col > 0:
-            x_coord = col-1
-            return self._grid[y_coord][x_coord]
-        if self._wrap:
-            return self._grid[y_coord][TILE_X-1]
-        return False
+        return self._cell_or_false(self.neighbour(row * self._width + col, 'w'))
     def get_east(self, row: int, col: int) -> Cell:
         """
         Get the cell to the east
         """
-        y_coord = row
-        if col < TILE_X-1:
-            x_coord = col+1
-            return self._grid[y_coord][x_coord]
-        if self._wrap:
-            return self._grid[y_coord][0]
-        return False
+        return self._cell_or_false(self.neighbour(row * self._width + col, 'e'))
+    def neighbour(self, index: int, direction: str) -> int:
+        """
+        Get the index of the cell in the specified direction (n,e,s,w)
+        Returns -1 off the edge of a grid that does not wrap
+        """
+        for neighbour_direction, neighbour_index in self.neighbour_indices(index):
+            if neighbour_direction == direction:
+                return neighbour_index
+        return -1
+    def neighbour_indices(self, index: int) -> list[tuple[str, int]]:
+        """
+        Get (direction, index) for cells in von neumann neighbourhood
+        """
+        width = self._width
+        col = index % width
+        result = []
+        if index >= width:
+            result.append(('n', index - width))
+        elif self._wrap:
+            result.append(('n', index + self._size - width))
+        if col < width - 1:
+            result.append(('e', index + 1))
+        elif self._wrap:
+            result.append(('e', index - col))
+        if index < self._size - width:
+            result.append(('s', index + width))
+        elif self._wrap:
+            result.append(('s', index - self._size + width))
+        if col > 0:
+            result.append(('w', index - 1))
+        elif self._wrap:
+            result.append(('w', index + width - 1))
+        return result
+    def neighbours(self, cell: Cell) -> list[tuple[str, Cell]]:
+        """
+        Get (direction, cell) for cells in von neumann neighbourhood
+        """
+        return [(direction, Cell(self, index)) for direction, index in self.neighbour_indices(cell.index)]
     def resolve_cell(self, cell: Cell) -> None:
         """
         Update cell with possibilities based on neighbouring cells
-        then if this cell has changed repeat the process on the
-        neighbouring cells
-        """
-        logging.info('checking %i,%i', cell.row, cell.col)
-        self._checked.append(cell)
-        if len(cell.choices) > 1:
-            logging.info('not set')
-            has_changed = False
-            has_changed |= self.update_allowed_choices(cell, 'n')
-            has_changed |= self.update_allowed_choices(cell, 's')
-            has_changed |= self.update_allowed_choices(cell, 'w')
-            has_changed |= self.update_allowed_choices(cell, 'e')
-            logging.info('choices left %i', len(cell.choices))
-            if has_changed:
-                self._changed.append(cell)
-                self.resolve_cell_neighbours(cell)
-        else:
-            logging.info('already set')
+        then if this cell has changed propagate to the rest of the grid
+        """
+        index = cell.index
+        instrument = self._instrument
+        if self._propagation == 'ac4':
+            if instrument is not None:
+                instrument.visit(index)
+            lost = 0
+            if self._domains[index] != 0:
+                for direction, restricter in self.neighbour_indices(index):
+                    out_direction = OPPOSITE_DIRECTION[direction]
+                    lost |= self._recount_supports(index, direction, restricter, out_direction)
+            if lost:
+                self.set_domain(index, self._domains[index] & ~lost)
+                if instrument is not None:
+                    instrument.narrow(index)
+                self.propagate([(index, lost)])
+        elif self._revise(index):
+            self.propagate([(index, None)])
     def resolve_cell_neighbours(self, cell: Cell) -> None:
         """
         Resolve cells in von neumann neighbourhood
         """
-        self.resolve_cell_neighbour(cell, 'n')
-        self.resolve_cell_neighbour(cell, 'e')
-        self.resolve_cell_neighbour(cell, 's')
-        self.resolve_cell_neighbour(cell, 'w')
-    def resolve_cell_neighbour(self, cell: Cell, out_direction: str):
+        index = cell.index
+        instrument = self._instrument
+        if self._propagation == 'ac4':
+            changes = []
+            for out_direction, neighbour_index in self.neighbour_indices(index):
+                if instrument is not None:
+                    instrument.visit(neighbour_index)
+                if self._domains[neighbour_index] != 0:
+                    direction = OPPOSITE_DIRECTION[out_direction]
+                    lost = self._recount_supports(neighbour_index, direction, index, out_direction)
+                    if lost:
+                        self.set_domain(neighbour_index, self._domains[neighbour_index] & ~lost)
+                        if instrument is not None:
+                            instrument.narrow(neighbour_index)
+                        changes.append((neighbour_index, lost))
+            self.propagate(changes)
+        else:
+            self.propagate([(index, None)])
+    def propagate(self, changes: list[tuple[int, int]]) -> None:
+        """
+        Propagate changes through the grid until nothing else narrows
+        changes is a list of (index, removed mask) for cells whose choices
+        have changed, ac3 ignores the removed mask and re-checks the neighbours
+        """
+        if self._propagation == 'ac4':
+            self._propagate_ac4(changes)
+        else:
+            self._propagate_ac3(changes)
+    def _stop_propagation(self) -> bool:
+        """Check if propagation should stop at a contradiction to recover."""
+        return self._contradiction is not None and self._recovery.enabled()
+    def revise(self, cell: Cell) -> bool:
+        """
+        Update allowed choices for cell from all directions
+        Returns True if the allowed choices has changed
+        """
+        return self._revise(cell.index)
+    def _revise(self, index: int) -> bool:
+        """
+        Update allowed choices for cell at index from all directions
+        Returns True if the allowed choices has changed
+        """
+        instrument = self._instrument
+        if instrument is not None:
+            instrument.visit(index)
+        domain = self._domains[index]
+        if domain == 0:
+            return False
+        choices = domain
+        for out_direction, restricter in self.neighbour_indices(index):
+            restricter_domain = self._domains[restricter]
+            # no restriction from a cell with no choices or every choice
+            if restricter_domain not in (0, self._full):
+                # mask of choices allowed by rules from other cell into this cell
+                choices &= self._tileset.allowed(restricter_domain, OPPOSITE_DIRECTION[out_direction])
+        if choices != domain:
+            self.set_domain(index, choices)
+            if instrument is not None:
+                instrument.narrow(index)
+            return True
+        return False
+    def _propagate_ac3(self, changes: list[tuple[int, int]]) -> None:
+        """
+        Worklist of cells to re-check, a cell that narrows queues its
+        neighbours, a cell already waiting in the queue is not added twice
         """
-        Resolve cell in specified direction (n,e,s,w)
+        queue = deque()
+        queued = set()
+        for index, _ in changes:
+            for _, neighbour_index in self.neighbour_indices(index):
+                if neighbour_index not in queued:
+                    queued.add(neighbour_index)
+                    queue.append(neighbour_index)
+        while queue:
+            index = queue.popleft()
+            queued.discard(index)
+            if self._revise(index):
+                if self._stop_propagation():
+                    return
+                for _, neighbour_index in self.neighbour_indices(index):
+                    if neighbour_index not in queued:
+                        queued.add(neighbour_index)
+                        queue.append(neighbour_index)
+    def _propagate_ac4(self, changes: list[tuple[int, int]]) -> None:
         """
-        neighbour_cell = self.get_cell_in_direction(cell, out_direction)
-        if neighbour_cell is not False:
-            self.resolve_cell(neighbour_cell)
+        Worklist of (index, removed mask), every tile removed from a cell
+        decrements the support its neighbours' tiles had from it and a
+        neighbour tile left with no support is removed in turn
+        """
+        instrument = self._instrument
+        queue = deque(changes)
+        while queue:
+            restricter, removed = queue.popleft()
+            if self._domains[restricter] == 0:
+                # a cell with no choices does not restrict its neighbours
+                continue
+            for out_direction, index in self.neighbour_indices(restricter):
+                if instrument is not None:
+                    instrument.visit(index)
+                if self._domains[index] == 0:
+                    continue
+                # the restricter is in the opposite direction from the cell
+                direction = OPPOSITE_DIRECTION[out_direction]
+                lost = self._update_supports(index, direction, restricter, out_direction, removed)
+                if lost:
+                    self.set_domain(index, self._domains[index] & ~lost)
+                    if instrument is not None:
+                        instrument.narrow(index)
+                    if self._stop_propagation():
+                        return
+                    queue.append((index, lost))
+    def _update_supports(self, index: int, direction: str, restricter: int, out_direction: str,
+                         removed: int) -> int:
+        """
+        Take the removed tiles of the restricter in direction
+        from the support counters of cell at index, a decided cell
+        has no counters and is checked against the restricter directly
+        Returns the mask of the cell's tiles left with no support
+        """
+        domain = self._domains[index]
+        if domain & (domain - 1) == 0:
+            return self._unsupported(domain, restricter, out_direction)
+        key = (index, direction)
+        counts = self._supports.get(key)
+        if counts is None:
+            # the restricter had every choice until now
+            counts = list(self._full_supports[out_direction])
+            self._supports[key] = counts
+        lost = 0
+        for removed_tile in indices(removed):
+            for i in indices(self._tileset.mask(removed_tile, out_direction) & domain):
+                counts[i] -= 1
+                if counts[i] == 0:
+                    lost |= 1 << i
+        return lost
+    def _recount_supports(self, index: int, direction: str, restricter: int, out_direction: str) -> int:
+        """
+        Count the support for the tiles of cell at index in the choices
+        of the restricter in direction
+        Returns the mask of the cell's tiles with no support
+        """
+        key = (index, direction)
+        restricter_domain = self._domains[restricter]
+        if restricter_domain in (0, self._full):
+            # no restriction from a cell with no choices or every choice
+            self._supports.pop(key, None)
+            return 0
+        domain = self._domains[index]
+        if domain & (domain - 1) == 0:
+            self._supports.pop(key, None)
+            return self._unsupported(domain, restricter, out_direction)
+        counts = [(restricter_domain & self._tileset.supporters(i, out_direction)).bit_count()
+                  for i in range(len(self._tileset.names()))]
+        self._supports[key] = counts
+        lost = 0
+        for i in indices(self._domains[index]):
+            if counts[i] == 0:
+                lost |= 1 << i
+        return lost
+    def _unsupported(self, domain: int, restricter: int, out_direction: str) -> int:
+        """Get domain if its one tile (or none) has no support in the restricter, otherwise 0."""
+        if domain == 0 or self._domains[restricter] & self._tileset.supporters(domain.bit_length() - 1, out_direction):
+            return 0
+        return domain
+    def _refresh_supports(self, restored: set[int]) -> None:
+        """
+        Recount the support counters to and from cells
+        whose choices have been put back
+        """
+        for index in restored:
+            for direction, neighbour_index in self.neighbour_indices(index):
+                out_direction = OPPOSITE_DIRECTION[direction]
+                self._recount_supports(index, direction, neighbour_index, out_direction)
+                self._recount_supports(neighbour_index, out_direction, index, direction)
     def update_allowed_choices(self, cell_to_restrict: Cell, out_direction: str) -> bool:
         """
         Update allowed choices for cell_to_restrict based on
@@ -250,161 +1252,14 @@ class Solver():
         # if a cell exists in out_direction
         restricter = self.get_cell_in_direction(cell_to_restrict, out_direction)
         if restricter is not False:
-            logging.debug('checking from %s', out_direction)
-            if len(restricter.choices) > 0:
-                if len(restricter.choices) < len(self._tileset.names()):
-                    in_direction = self._opposite_direction[out_direction]
-                    logging.debug('restricting')
-                    # create list of all allowed choices
-                    allowed = []
-                    for choice in restricter.choices:
-                        # get rules that apply from other cell into this cell
-                        for allow in self._tileset.rule(choice, in_direction):
-                            allowed.append(allow)
-                    choices = []
+            if restricter.domain != 0:
+                if restricter.domain != self._full:
+                    in_direction = OPPOSITE_DIRECTION[out_direction]
+                    # mask of choices allowed by rules from other cell into this cell
+                    allowed = self._tileset.allowed(restricter.domain, in_direction)
                     # remove all choices not allowed
-                    for choice in cell_to_restrict.choices:
-                        if choice in allowed:
-                            choices.append(choice)
-                    if cell_to_restrict.choices != choices:
-                        cell_to_restrict.choices = choices
+                    choices = cell_to_restrict.domain & allowed
+                    if cell_to_restrict.domain != choices:
+                        cell_to_restrict.domain = choices
                         return True
         return False
-
-class App():
-    """Wave function collapse application"""
-    def __init__(self, solver: Solver, delay: float, shownumbers: bool, showchanged: bool) -> None:
-        self._solver = solver
-        self._delay = delay
-        self._shownumbers = shownumbers
-        self._showchanged = showchanged
-
-        self._running = True
-        self._display_surf = None
-        self._width = TILE_WIDTH * TILE_X
-        self._height = TILE_HEIGHT * TILE_Y
-        self._size = (self._width, self._height)
-        self._time = time.time()
-        self._counter = 0
-        self._complete = False
-        self.font_s = None
-        self.font_l = None
-
-        self._image_cache = {}
-    def on_init(self) -> bool:
-        """On init"""
-        pygame.init()
-        pygame.display.set_caption("Solver (Seed:%i)" % self._solver.seed)
-        self._display_surf = pygame.display.set_mode(self._size,
-                                                     pygame.HWSURFACE | pygame.DOUBLEBUF)
-        self._running = True
-        #self.font = pygame.font.SysFont('courier.ttf', 72)
-        font_name = pygame.font.get_default_font()
-        logging.info("System font: %s", font_name)
-        self.font_s = pygame.font.SysFont(None, 22)
-        self.font_l = pygame.font.SysFont(None, 33)
-        return True
-    def on_event(self, event: pygame.event.Event) -> None:
-        """On event"""
-        if event.type == pygame.QUIT:
-            self._running = False
-        elif event.type == pygame.KEYDOWN:
-            if event.key == 27:
-                self._running = False
-        else:
-            logging.debug(event)
-    def on_loop(self, elapsed: float) -> None:
-        """On loop"""
-        self._counter+=elapsed
-        if self._counter > self._delay:
-            logging.info("tick")
-            self._counter = 0
-            if not self._complete:
-                if self._solver.solve():
-                    self._complete = True
-    def on_render(self) -> None:
-        """Render the solver"""
-        self._display_surf.fill(COLOUR_WHITE)
-        for row in range(0, TILE_Y):
-            for col in range(0, TILE_X):
-                x_coord = col*TILE_WIDTH
-                y_coord = row*TILE_HEIGHT
-                cell = self._solver.get_cell(row, col)
-                num_choices = len(cell.choices)
-                if num_choices == 0:
-                    pygame.draw.rect(self._display_surf,
-                                     COLOUR_RED,
-                                     (x_coord, y_coord, TILE_WIDTH, TILE_HEIGHT))
-                elif num_choices == 1:
-                    self._display_surf.blit(self._solver.get_image(cell.choices[0]),
-                                            (x_coord, y_coord))
-                elif self._shownumbers:
-                    img = self.font_l.render(str(len(cell.choices)), True, (0,0,0))
-                    self._display_surf.blit(img, (x_coord+3, y_coord+6))
-                else:
-                    img = self.get_or_cache_image(cell)
-                    self._display_surf.blit(img, (x_coord, y_coord))
-        if self._complete is False:
-            if self._showchanged:
-                for cell in self._solver.checked_cells():
-                    x_coord = cell.col * TILE_WIDTH
-                    y_coord = cell.row * TILE_HEIGHT
-                    pygame.draw.rect(self._display_surf,
-                                     COLOUR_GREEN,
-                                     (x_coord, y_coord, TILE_WIDTH, TILE_HEIGHT),
-                                     3)
-                for cell in self._solver.changed_cells():
-                    x_coord = cell.col * TILE_WIDTH
-                    y_coord = cell.row * TILE_HEIGHT
-                    pygame.draw.rect(self._display_surf,
-                                     COLOUR_ORANGE,
-                                     (x_coord, y_coord, TILE_WIDTH, TILE_HEIGHT),
-                                     3)
-                resolved = self._solver.resolved_cell()
-                if resolved is not None:
-                    x_coord = resolved.col * TILE_WIDTH
-                    y_coord = resolved.row * TILE_HEIGHT
-                    pygame.draw.rect(self._display_surf,
-                                     COLOUR_YELLOW,
-                                     (x_coord, y_coord, TILE_WIDTH, TILE_HEIGHT),
-                                     3)
-                    text = self.font_s.render('checked cells', True, COLOUR_GREEN)
-                    self._display_surf.blit(text, (10, 10))
-                    text = self.font_s.render('changed cells', True, COLOUR_ORANGE)
-                    self._display_surf.blit(text, (10, 30))
-                    text = self.font_s.render('resolved cell', True, COLOUR_YELLOW)
-                    self._display_surf.blit(text, (10, 50))
-            text = self.font_s.render('images cached: {0}'.format(len(self._image_cache)),
-                                      True, COLOUR_RED)
-            self._display_surf.blit(text, (10, self._height - 20))
-        pygame.display.update()
-    def get_or_cache_image(self, cell: Cell) -> pygame.Surface:
-        """Get or cache tile image"""
-        key = ','.join(cell.choices)
-        if key not in self._image_cache:
-            num_choices = len(cell.choices)
-            ratio = 255/num_choices
-            i = pygame.Surface((TILE_WIDTH, TILE_HEIGHT))
-            i.fill(COLOUR_WHITE)
-            for choice in cell.choices:
-                tile = self._solver.get_image(choice).copy()
-                tile.set_alpha(ratio)
-                i.blit(tile, (0, 0))
-            self._image_cache[key] = i
-        return self._image_cache[key]
-    def on_cleanup(self) -> None:
-        """On cleanup"""
-        pygame.quit()
-    def on_execute(self) -> None:
-        """On execute"""
-        if not self.on_init():
-            self._running = False
-        while self._running:
-            current = time.time()
-            elapsed = current - self._time
-            self._time = current
-            for event in pygame.event.get():
-                self.on_event(event)
-            self.on_loop(elapsed)
-            self.on_render()
-        self.on_cleanup()
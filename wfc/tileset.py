@@ -0,0 +1,176 @@
+"""Tileset definition files"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import solver
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'tiles', 'tileset.json')
+
+# compiled tileset layout, bump VERSION when it changes
+MAGIC = b'WFCT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH')
+
+class TileSetError(ValueError):
+    """Tileset definition is not valid."""
+
+def parse(definition: dict) -> dict:
+    """
+    Get tiles from a tileset definition in the form TileSet takes
+    A rule is a list of tile names or the name of a list in groups
+    Raises TileSetError if the definition is not valid
+    """
+    if not isinstance(definition, dict) or not isinstance(definition.get('tiles'), dict):
+        raise TileSetError('tileset must have a tiles object')
+    groups = definition.get('groups', {})
+    if not isinstance(groups, dict):
+        raise TileSetError('tileset groups must be an object')
+    for group, rule in groups.items():
+        if not _is_rule(rule):
+            raise TileSetError('group {0} must be a list of tile names'.format(group))
+    tiles = {}
+    for name, tile in definition['tiles'].items():
+        try:
+            weight = tile['weight']
+            rules = tile['rules']
+        except (KeyError, TypeError) as ex:
+            raise TileSetError('tile {0} must have rules and a weight'.format(name)) from ex
+        if not isinstance(rules, dict):
+            raise TileSetError('tile {0} rules must be an object'.format(name))
+        resolved = {}
+        for direction in solver.DIRECTIONS:
+            rule = rules.get(direction)
+            if isinstance(rule, str):
+                if rule not in groups:
+                    raise TileSetError('tile {0} uses unknown group {1}'.format(name, rule))
+                rule = groups[rule]
+            if not isinstance(rule, list):
+                raise TileSetError('tile {0} has no rule for {1}'.format(name, direction))
+            if not _is_rule(rule):
+                raise TileSetError('tile {0} rule {1} must be a list of tile names'.format(name, direction))
+            resolved[direction] = rule
+        tiles[name] = {'rules': resolved, 'weight': weight}
+    validate(tiles)
+    return tiles
+
+def _is_rule(rule) -> bool:
+    """Check rule is a list of tile names."""
+    return isinstance(rule, list) and all(isinstance(other, str) for other in rule)
+
+def validate(tiles: dict) -> list[str]:
+    """
+    Check tiles, raising TileSetError for an empty tileset,
+    weights that are not positive and rules naming unknown tiles
+    Returns warnings for rules that are not symmetric, which are logged
+    """
+    if len(tiles) == 0:
+        raise TileSetError('tileset has no tiles')
+    if len(tiles) > 0xffff:
+        raise TileSetError('tileset has {0} tiles, at most 65535 are supported'.format(len(tiles)))
+    for name, tile in tiles.items():
+        weight = tile['weight']
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+            raise TileSetError('tile {0} must have a weight above zero, got {1}'.format(name, weight))
+        for direction, rule in tile['rules'].items():
+            unknown = [other for other in rule if other not in tiles]
+            if len(unknown) > 0:
+                raise TileSetError('tile {0} rule {1} has unknown tiles {2}'.format(
+                    name, direction, ', '.join(unknown)))
+    warnings = []
+    allowed = {name: {direction: set(rule) for direction, rule in tile['rules'].items()}
+               for name, tile in tiles.items()}
+    for name, tile in tiles.items():
+        for direction, rule in tile['rules'].items():
+            opposite = solver.OPPOSITE_DIRECTION[direction]
+            for other in rule:
+                if name not in allowed[other][opposite]:
+                    warnings.append('{0} allows {1} to the {2} but {1} does not allow {0} to the {3}'.format(
+                        name, other, direction, opposite))
+    for warning in warnings:
+        logging.warning('tileset rule not symmetric: %s', warning)
+    return warnings
+
+def pack(tileset: solver.TileSet) -> bytes:
+    """Get compiled tileset, names, weights and the masks for each direction."""
+    names = tileset.names()
+    width = (len(names) + 7) // 8
+    parts = [HEADER.pack(MAGIC, VERSION, len(names), width)]
+    for name in names:
+        encoded = name.encode('utf-8')
+        parts.append(struct.pack('<B', len(encoded)))
+        parts.append(encoded)
+    parts.append(struct.pack('<{0}d'.format(len(names)), *(tileset.weight(name) for name in names)))
+    for direction in solver.DIRECTIONS:
+        for i in range(0, len(names)):
+            parts.append(tileset.mask(i, direction).to_bytes(width, 'little'))
+    return b''.join(parts)
+
+def unpack(data: bytes, image_dir: str = solver.IMAGE_DIR) -> solver.TileSet:
+    """Get tileset from compiled data, raises TileSetError if it is not a compiled tileset."""
+    try:
+        magic, version, count, width = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise TileSetError('not a version {0} compiled tileset'.format(VERSION))
+        offset = HEADER.size
+        names = []
+        for _ in range(0, count):
+            length = data[offset]
+            names.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+        weights = struct.unpack_from('<{0}d'.format(count), data, offset)
+        offset += 8 * count
+        masks = {}
+        for direction in solver.DIRECTIONS:
+            masks[direction] = []
+            for _ in range(0, count):
+                masks[direction].append(int.from_bytes(data[offset:offset + width], 'little'))
+                offset += width
+    except (struct.error, IndexError, UnicodeDecodeError) as ex:
+        raise TileSetError('compiled tileset is truncated') from ex
+    if offset != len(data):
+        raise TileSetError('compiled tileset has trailing data')
+    return solver.TileSet.from_masks(names, weights, masks, image_dir)
+
+def load(path: str = DEFAULT_PATH, cache_dir: str = None) -> solver.TileSet:
+    """
+    Load a tileset definition file, images are read from the same directory
+    The compiled tileset is kept in cache_dir (.compiled next to the file
+    by default) keyed by a hash of the file so later loads skip parsing
+    and validation
+    """
+    with open(path, 'rb') as file:
+        content = file.read()
+    image_dir = os.path.dirname(os.path.abspath(path))
+    if cache_dir is None:
+        cache_dir = os.path.join(image_dir, '.compiled')
+    compiled = os.path.join(cache_dir, '{0}.tileset'.format(hashlib.sha256(content).hexdigest()))
+    try:
+        with open(compiled, 'rb') as file:
+            return unpack(file.read(), image_dir)
+    except FileNotFoundError:
+        pass
+    except TileSetError as ex:
+        logging.warning('recompiling %s: %s', path, ex)
+    try:
+        definition = json.loads(content)
+    except ValueError as ex:
+        raise TileSetError('{0} is not valid json: {1}'.format(path, ex)) from ex
+    tileset = solver.TileSet(parse(definition), image_dir)
+    data = pack(tileset)
+    # checkpoints match their tileset by digest, so a later load from the cache must give the same one
+    if unpack(data, image_dir).digest() != tileset.digest():
+        raise TileSetError('compiled tileset for {0} does not match the definition'.format(path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written aside and renamed so concurrent loads never read half a file
+        temp = '{0}.{1}.tmp'.format(compiled, os.getpid())
+        with open(temp, 'wb') as file:
+            file.write(data)
+        os.replace(temp, compiled)
+    except OSError as ex:
+        logging.warning('could not cache compiled tileset %s: %s', compiled, ex)
+    return tileset
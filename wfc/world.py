@@ -0,0 +1,268 @@
+"""Chunked world generation"""
+
+import array
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import batch
+import solver
+
+# set in each worker process by _init_worker
+_tileset = None
+_options = None
+
+# (dx, dy) to the neighbouring chunk in each direction
+NEIGHBOUR_CHUNKS = {
+    'n': (0, -1),
+    'e': (1, 0),
+    's': (0, 1),
+    'w': (-1, 0)
+}
+
+def parse_region(region: str) -> tuple[int, int, int, int]:
+    """Parse X,Y,WIDTHxHEIGHT into (x, y, width, height)."""
+    try:
+        x, y, size = region.split(',')
+        width, height = batch.parse_size(size)
+        return (int(x), int(y), width, height)
+    except ValueError as ex:
+        raise ValueError('region must be X,Y,WIDTHxHEIGHT, got {0}'.format(region)) from ex
+
+def _init_worker(tileset: solver.TileSet, options: dict) -> None:
+    """Keep the tileset and options for each worker process."""
+    global _tileset, _options # pylint: disable=global-statement
+    _tileset = tileset
+    _options = options
+
+def _solve_chunk(job: tuple[int, dict, int]) -> tuple[bytes, int]:
+    """Solve one chunk in a worker process, job is (seed, edges, retries)."""
+    return solve_chunk(_tileset, _options, *job)
+
+def solve_chunk(tileset: solver.TileSet, options: dict, seed: int, edges: dict,
+                retries: int) -> tuple[bytes, int]:
+    """
+    Solve one chunk, retrying with a derived seed if it has contradictions
+    edges maps a direction to the tile indices along the facing edge
+    of the neighbouring chunk in that direction, they constrain the
+    cells along this chunk's edge so restarts keep them
+    Cells that neighbouring edges disagree on are left with no tile
+    (-1) and counted as contradictions
+    Returns (tile indices as bytes, contradictions)
+    """
+    width = options['width']
+    height = options['height']
+    constraints = solver.Constraints(tileset)
+    for direction, edge in edges.items():
+        for i, tile in enumerate(edge):
+            if tile == -1:
+                continue
+            # rules from the neighbouring tile back into this chunk
+            allowed = tileset.allowed(1 << tile, solver.OPPOSITE_DIRECTION[direction])
+            if direction == 'n':
+                constraints.limit(0, i, allowed)
+            elif direction == 's':
+                constraints.limit(height - 1, i, allowed)
+            elif direction == 'w':
+                constraints.limit(i, 0, allowed)
+            else:
+                constraints.limit(i, width - 1, allowed)
+    conflicts = [cell for cell, mask in constraints.masks().items() if mask == 0]
+    for row, col in conflicts:
+        constraints.remove(row, col)
+    if len(conflicts) > 0:
+        logging.info('chunk with seed %i: edges disagree on %i cells', seed, len(conflicts))
+    for attempt in range(0, retries + 1):
+        s = solver.Solver(tileset, solver.derive_seed(seed, attempt) if attempt else seed, **options)
+        try:
+            s.constrain(constraints)
+        except solver.UnsatisfiableError as ex:
+            # no seed satisfies the edges, solve around the cells they leave
+            # with no choices, without recovering as that would only fail again
+            logging.warning('chunk with seed %i: %s', seed, ex)
+            s = solver.Solver(tileset, seed, **dict(options, recovery=None))
+            try:
+                s.constrain(constraints)
+            except solver.UnsatisfiableError:
+                pass
+            s.run()
+            break
+        if s.run():
+            break
+        logging.info('chunk with seed %i has contradictions, attempt %i', seed, attempt)
+    tiles = array.array('h', (tile for row in s.tile_grid() for tile in row))
+    for row, col in conflicts:
+        tiles[row * width + col] = -1
+    return (tiles.tobytes(), s.contradictions + len(conflicts))
+
+class World():
+    """
+    Unbounded map generated in fixed size chunks on demand
+    Each chunk is seeded from the world seed and its chunk coordinates
+    and constrained by the edges of neighbouring chunks generated before
+    it, so the map depends on the order chunks are first asked for
+    """
+    def __init__(self, tileset: solver.TileSet, seed: int, chunk_width: int = 32, chunk_height: int = 32,
+                 cache_size: int = 64, spill_dir: str = None, jobs: int = 1, retries: int = 3,
+                 **options) -> None:
+        if cache_size < 1:
+            raise ValueError('cache must hold at least one chunk')
+        self._tileset = tileset
+        self._seed = seed
+        self._chunk_width = chunk_width
+        self._chunk_height = chunk_height
+        self._cache_size = cache_size
+        self._jobs = jobs
+        self._retries = retries
+        # chunks are solved without wrapping, the edges are constraints so restarts keep them
+        options['wrap'] = False
+        options['width'] = chunk_width
+        options['height'] = chunk_height
+        self._options = options
+        self._temp_dir = None
+        if spill_dir is None:
+            self._temp_dir = tempfile.mkdtemp(prefix='wfc-chunks-')
+            spill_dir = self._temp_dir
+        os.makedirs(spill_dir, exist_ok=True)
+        self._spill_dir = spill_dir
+        # most recently used last
+        self._cache = OrderedDict()
+        self._spilled = set()
+        self._executor = None
+        self._stats = {'generated': 0, 'hits': 0, 'loads': 0, 'spills': 0, 'contradictions': 0}
+    def __enter__(self) -> 'World':
+        return self
+    def __exit__(self, *args) -> None:
+        self.close()
+    @property
+    def chunk_width(self) -> int:
+        """Get chunk width in tiles."""
+        return self._chunk_width
+    @property
+    def chunk_height(self) -> int:
+        """Get chunk height in tiles."""
+        return self._chunk_height
+    @property
+    def stats(self) -> dict:
+        """Get counts of generated, cached, loaded and spilled chunks."""
+        return dict(self._stats)
+    def close(self) -> None:
+        """Stop worker processes and remove a temporary spill directory."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+    def has_chunk(self, cx: int, cy: int) -> bool:
+        """Check if chunk has been generated."""
+        return (cx, cy) in self._cache or (cx, cy) in self._spilled
+    def chunk(self, cx: int, cy: int) -> array.array:
+        """Get tile indices of chunk by row, generating it if needed."""
+        if not self.has_chunk(cx, cy):
+            self.generate([(cx, cy)])
+        return self._get(cx, cy)
+    def tile(self, x: int, y: int) -> int:
+        """Get tile index at world coordinates."""
+        cx, col = divmod(x, self._chunk_width)
+        cy, row = divmod(y, self._chunk_height)
+        return self.chunk(cx, cy)[row * self._chunk_width + col]
+    def region(self, x: int, y: int, width: int, height: int) -> list[list[int]]:
+        """Get tile indices by row for a region in world coordinates."""
+        cx0 = x // self._chunk_width
+        cy0 = y // self._chunk_height
+        cx1 = (x + width - 1) // self._chunk_width
+        cy1 = (y + height - 1) // self._chunk_height
+        self.generate([(cx, cy) for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1)])
+        grid = []
+        for row_y in range(y, y + height):
+            row = []
+            cy, row_in_chunk = divmod(row_y, self._chunk_height)
+            col_x = x
+            while col_x < x + width:
+                cx, col_in_chunk = divmod(col_x, self._chunk_width)
+                take = min(self._chunk_width - col_in_chunk, x + width - col_x)
+                start = row_in_chunk * self._chunk_width + col_in_chunk
+                row.extend(self._get(cx, cy)[start:start + take])
+                col_x += take
+            grid.append(row)
+        return grid
+    def generate(self, coords: list[tuple[int, int]]) -> None:
+        """
+        Generate the chunks in coords that do not exist yet
+        in two checkerboard waves, chunks in a wave share no edges
+        so each wave is solved in parallel across worker processes
+        """
+        missing = []
+        for chunk_coords in dict.fromkeys(coords):
+            if not self.has_chunk(*chunk_coords):
+                missing.append(chunk_coords)
+        for parity in (0, 1):
+            wave = [(cx, cy) for cx, cy in missing if (cx + cy) % 2 == parity]
+            if len(wave) == 0:
+                continue
+            jobs = [(solver.derive_seed(self._seed, cx, cy), self._edges(cx, cy), self._retries)
+                    for cx, cy in wave]
+            if self._jobs > 1 and len(wave) > 1:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self._jobs, initializer=_init_worker,
+                                                         initargs=(self._tileset, self._options))
+                results = self._executor.map(_solve_chunk, jobs)
+            else:
+                results = (solve_chunk(self._tileset, self._options, *job) for job in jobs)
+            for (cx, cy), (data, contradictions) in zip(wave, results):
+                tiles = array.array('h')
+                tiles.frombytes(data)
+                self._stats['generated'] += 1
+                self._stats['contradictions'] += contradictions
+                self._put(cx, cy, tiles)
+            logging.info('generated %i chunks', len(wave))
+    def _edges(self, cx: int, cy: int) -> dict:
+        """Get the facing edges of generated chunks next to chunk."""
+        edges = {}
+        width = self._chunk_width
+        height = self._chunk_height
+        for direction, (dx, dy) in NEIGHBOUR_CHUNKS.items():
+            if not self.has_chunk(cx + dx, cy + dy):
+                continue
+            tiles = self._get(cx + dx, cy + dy)
+            if direction == 'n':
+                edges[direction] = list(tiles[(height - 1) * width:])
+            elif direction == 's':
+                edges[direction] = list(tiles[:width])
+            elif direction == 'w':
+                edges[direction] = list(tiles[width - 1::width])
+            else:
+                edges[direction] = list(tiles[0::width])
+        return edges
+    def _path(self, cx: int, cy: int) -> str:
+        """Get spill file path for chunk."""
+        return os.path.join(self._spill_dir, '{0}_{1}.chunk'.format(cx, cy))
+    def _get(self, cx: int, cy: int) -> array.array:
+        """Get a generated chunk from the cache or the spill directory."""
+        key = (cx, cy)
+        tiles = self._cache.get(key)
+        if tiles is not None:
+            self._cache.move_to_end(key)
+            self._stats['hits'] += 1
+            return tiles
+        tiles = array.array('h')
+        with open(self._path(cx, cy), 'rb') as file:
+            tiles.frombytes(file.read())
+        self._stats['loads'] += 1
+        self._put(cx, cy, tiles)
+        return tiles
+    def _put(self, cx: int, cy: int, tiles: array.array) -> None:
+        """Add chunk to the cache, spilling the least recently used to disk."""
+        self._cache[(cx, cy)] = tiles
+        self._cache.move_to_end((cx, cy))
+        while len(self._cache) > self._cache_size:
+            (old_cx, old_cy), old_tiles = self._cache.popitem(last=False)
+            if (old_cx, old_cy) not in self._spilled:
+                with open(self._path(old_cx, old_cy), 'wb') as file:
+                    file.write(old_tiles.tobytes())
+                self._spilled.add((old_cx, old_cy))
+                self._stats['spills'] += 1